@@ -1,5 +1,51 @@
+import re
+import json
+import struct
 from enum import Enum
 
+# Message codecs. Text is the original key=value&... format; binary is
+# negotiated during LGIN and marked on each frame so either side can decode it.
+CODEC_TEXT = 'text'
+CODEC_BINARY = 'binary'
+
+# Binary codec layout: uint16 REQS code, then fields until the end of the
+# body. Each field is a key (one byte from BINARY_KEYS, or KEY_LITERAL followed
+# by a length-prefixed name) and a tagged, length-prefixed value. Key codes
+# are positional, so new keys must only ever be appended.
+BINARY_KEYS = (
+    'status', 'message', 'username', 'password', 'room', 'device',
+    'filter_type', 'group', 'devices', 'pin', 'brightness', 'color', 'codec',
+    'page_size', 'cursor', 'next_cursor', 'req_id', 'changes', 'results',
+    'atomic', 'query', 'device_type', 'min_brightness', 'max_brightness',
+    'since', 'version', 'removed', 'sub_id',
+)
+KEY_CODES = {k: i for i, k in enumerate(BINARY_KEYS, 1)}
+KEY_LITERAL = 0xFF
+
+TAG_STR8 = 1
+TAG_STR32 = 2
+TAG_INT = 3
+TAG_JSON = 4
+
+# Values of these types travel as JSON instead of their str() form
+STRUCTURED_TYPES = (dict, list, tuple)
+
+# The only keys decoded from JSON on receipt. A peer can mark any key as
+# JSON, but handlers expect plain strings everywhere else.
+STRUCTURED_KEYS = frozenset(('devices', 'changes', 'results', 'removed', 'pin_codes'))
+
+# Range of ints the binary codec sends as TAG_INT; others go as strings
+INT_MIN = -2 ** 63
+INT_MAX = 2 ** 63 - 1
+
+_ESCAPED = re.compile('%(25|26|3D)')
+_UNESCAPE = {'25': '%', '26': '&', '3D': '='}
+
+_U8 = struct.Struct('!B')
+_U16 = struct.Struct('!H')
+_U32 = struct.Struct('!I')
+_I64 = struct.Struct('!q')
+
 class REQS(Enum):
     LGIN = 100  
     LOUT = 101  
@@ -7,6 +53,11 @@ class REQS(Enum):
     CHG_STATUS = 103
     SRCH = 104
     EXIT = 105 
+    BATCH = 106
+    SUBSCRIBE = 107
+    UNSUBSCRIBE = 108
+    # Pushed by the server to subscribers, never sent by clients
+    NOTIFY = 109
 
     TURN_ON = 200
     TURN_OFF = 201
@@ -15,10 +66,48 @@ class REQS(Enum):
 
     CHECK_STATUS = 204
 
+class EncodedValue:
+    """
+    A structured value serialized to JSON once, for responses that are sent
+    many times. CSmessage marshals it exactly like the value it wraps.
+    """
+    __slots__ = ('json', '_text', '_binary')
+
+    def __init__(self, value):
+        self.json = json.dumps(value, separators=(',', ':'))
+        self._text = None
+        self._binary = None
+
+    def text(self):
+        """The value as the text codec writes it"""
+        if self._text is None:
+            self._text = _escape(self.json)
+        return self._text
+
+    def binary(self):
+        """The tagged value as the binary codec writes it"""
+        if self._binary is None:
+            vb = self.json.encode('utf-8')
+            self._binary = _U8.pack(TAG_JSON) + _U32.pack(len(vb)) + vb
+        return self._binary
+
+def _escape(text):
+    """Percent-encodes the characters the text codec uses as separators"""
+    if '%' in text or '&' in text or '=' in text:
+        return text.replace('%', '%25').replace('&', '%26').replace('=', '%3D')
+    return text
+
+def _unescape(text):
+    if '%' in text:
+        return _ESCAPED.sub(lambda m: _UNESCAPE[m.group(1)], text)
+    return text
+
 class CSmessage:
     PJOIN = '&'
     VJOIN = '{}={}'
     VJOIN1 = '='
+    # Text codec field listing the keys whose values are JSON encoded
+    JSON_KEYS = '_json'
 
     def __init__(self):
         self._data = {}
@@ -30,6 +119,14 @@ class CSmessage:
     def getType(self):
         return self._data['type']
 
+    def setRequestId(self, req_id):
+        self._data['req_id'] = req_id
+
+    def getRequestId(self):
+        """Request ID echoed by the server, used to match pipelined responses"""
+        req_id = self._data.get('req_id')
+        return int(req_id) if req_id is not None else None
+
     def addValue(self, key, value):
         self._data[key] = value
 
@@ -39,12 +136,99 @@ class CSmessage:
     def marshal(self):
 
         """Convert message to string format for transmission"""
-        pairs = [
-            CSmessage.VJOIN.format(k, v.name if isinstance(v, REQS) else v)
-            for (k, v) in self._data.items()
-        ]
+        pairs = []
+        json_keys = []
+        for (k, v) in self._data.items():
+            if isinstance(v, EncodedValue):
+                json_keys.append(k)
+                pairs.append(CSmessage.VJOIN.format(_escape(k), v.text()))
+                continue
+            if isinstance(v, STRUCTURED_TYPES):
+                json_keys.append(k)
+                v = json.dumps(v, separators=(',', ':'))
+            elif isinstance(v, REQS):
+                v = v.name
+            pairs.append(CSmessage.VJOIN.format(_escape(k), _escape(str(v))))
+        if json_keys:
+            pairs.append(CSmessage.VJOIN.format(CSmessage.JSON_KEYS, _escape(','.join(json_keys))))
         return CSmessage.PJOIN.join(pairs)
 
+    def marshal_binary(self) -> bytes:
+        """Convert message to the compact binary format"""
+        t = self._data['type']
+        out = [_U16.pack(t.value if isinstance(t, REQS) else int(t))]
+        for k, v in self._data.items():
+            if k == 'type':
+                continue
+            code = KEY_CODES.get(k)
+            if code:
+                out.append(_U8.pack(code))
+            else:
+                kb = k.encode('utf-8')
+                out.append(_U8.pack(KEY_LITERAL) + _U8.pack(len(kb)) + kb)
+            if type(v) is int and INT_MIN <= v <= INT_MAX:
+                out.append(_U8.pack(TAG_INT) + _I64.pack(v))
+                continue
+            if isinstance(v, EncodedValue):
+                out.append(v.binary())
+                continue
+            if isinstance(v, STRUCTURED_TYPES):
+                vb = json.dumps(v, separators=(',', ':')).encode('utf-8')
+                out.append(_U8.pack(TAG_JSON) + _U32.pack(len(vb)) + vb)
+                continue
+            vb = str(v.name if isinstance(v, REQS) else v).encode('utf-8')
+            if len(vb) < 256:
+                out.append(_U8.pack(TAG_STR8) + _U8.pack(len(vb)) + vb)
+            else:
+                out.append(_U8.pack(TAG_STR32) + _U32.pack(len(vb)) + vb)
+        return b''.join(out)
+
+    def unmarshal_binary(self, data: bytes):
+        """Convert a binary message back into a structured message"""
+        self._data = {}
+        mv = memoryview(data)
+        code = _U16.unpack_from(mv, 0)[0]
+        try:
+            self._data['type'] = REQS(code)
+        except ValueError:
+            self._data['type'] = code
+        pos = 2
+        end = len(mv)
+        while pos < end:
+            kcode = mv[pos]
+            pos += 1
+            if kcode == KEY_LITERAL:
+                klen = mv[pos]
+                key = bytes(mv[pos + 1:pos + 1 + klen]).decode('utf-8')
+                pos += 1 + klen
+            elif 0 < kcode <= len(BINARY_KEYS):
+                key = BINARY_KEYS[kcode - 1]
+            else:
+                raise ValueError(f"Unknown key code {kcode}")
+            tag = mv[pos]
+            pos += 1
+            if tag == TAG_INT:
+                self._data[key] = _I64.unpack_from(mv, pos)[0]
+                pos += 8
+                continue
+            if tag == TAG_JSON:
+                vlen = _U32.unpack_from(mv, pos)[0]
+                pos += 4
+                value = bytes(mv[pos:pos + vlen])
+                self._data[key] = json.loads(value) if key in STRUCTURED_KEYS else value.decode('utf-8')
+                pos += vlen
+                continue
+            if tag == TAG_STR8:
+                vlen = mv[pos]
+                pos += 1
+            elif tag == TAG_STR32:
+                vlen = _U32.unpack_from(mv, pos)[0]
+                pos += 4
+            else:
+                raise ValueError(f"Unknown value tag {tag} for '{key}'")
+            self._data[key] = bytes(mv[pos:pos + vlen]).decode('utf-8')
+            pos += vlen
+
     def unmarshal(self, data):
         """
         Convert received string data back into a structured message.
@@ -58,6 +242,7 @@ class CSmessage:
             for p in params:
                 try:
                     k, v = p.split(CSmessage.VJOIN1, 1)
+                    k, v = _unescape(k), _unescape(v)
                     if k == "type":
                         try:
                             self._data[k] = REQS[v]  # Convert string back to REQS Enum
@@ -68,5 +253,13 @@ class CSmessage:
                 except ValueError:
                     print(f"[ERROR] Failed to parse parameter: {p}")  # Debugging
 
+            # Decode structured values once every pair has been read
+            for k in self._data.pop(CSmessage.JSON_KEYS, '').split(','):
+                if k in self._data and k in STRUCTURED_KEYS:
+                    try:
+                        self._data[k] = json.loads(self._data[k])
+                    except ValueError:
+                        print(f"[ERROR] Failed to decode JSON value: {k}")  # Debugging
+
 
 
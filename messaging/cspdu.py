@@ -1,16 +1,45 @@
 import socket
-from messaging.csmessage import CSmessage
+import struct
+from messaging.csmessage import CSmessage, CODEC_TEXT, CODEC_BINARY
+
+# Frame formats. Legacy frames start with the body size as 4 ASCII digits and
+# are limited to 9999 bytes. V1 frames start with the version byte, which can
+# never be an ASCII digit, followed by a flags byte and a uint32 body size.
+FRAME_LEGACY = 0
+FRAME_V1 = 1
+
+LEGACY_HEADER_SIZE = 4
+LEGACY_MAX_SIZE = 9999
+V1_HEADER = struct.Struct('!BBI')
+
+# V1 flag bits. 0x01 is reserved for payload compression; FLAG_BINARY_CODEC
+# marks a body encoded with CSmessage.marshal_binary. Frames carrying bits
+# this version does not understand are rejected.
+FLAG_BINARY_CODEC = 0x02
+KNOWN_FLAGS = FLAG_BINARY_CODEC
+
+# Bytes requested from the socket per read
+RECV_CHUNK = 65536
 
 class SmartHomePDU:
     """
     Handles sending and receiving messages over a TCP connection for the Smart Home system.
     """
 
-    def __init__(self, comm: socket):
+    def __init__(self, comm: socket, frame_version: int = FRAME_LEGACY, codec: str = CODEC_TEXT):
         """
         Initializes the PDU with a socket connection.
+        Clients pass FRAME_V1 to use binary headers; a peer created with the
+        default answers in whatever format it last received, so old clients
+        keep working against a new server. The codec follows the peer the
+        same way once the binary codec has been agreed at login.
         """
         self._sock = comm
+        self.frame_version = frame_version
+        self.codec = codec
+        self._rbuf = bytearray()
+        self._chunk = bytearray(RECV_CHUNK)
+        self._mv = memoryview(self._chunk)
 
     # def _loop_recv(self, size: int):
     #     """
@@ -25,35 +54,129 @@ class SmartHomePDU:
     #         size -= rsize
     #     return data
 
-    def _loop_recv(self, size: int):
-        data = bytearray(size)
-        mv = memoryview(data)
-        total_received = 0
+    def _fill(self):
+        """
+        Reads whatever the socket has into the receive buffer. Pipelined
+        frames that arrive together stay buffered for the next call.
+        """
+        rsize = self._sock.recv_into(self._chunk)
+        if rsize == 0:
+            raise ConnectionError("[ERROR] Socket closed while receiving data")
+        self._rbuf += self._mv[:rsize]
+        print(f"[DEBUG] Received {rsize} bytes, Buffered: {len(self._rbuf)}")
+
+    def has_buffered_frame(self) -> bool:
+        """
+        True if a complete frame is already buffered, so receive_message
+        will not block.
+        """
+        if not self._rbuf:
+            return False
+        hsize = self.header_size(self._rbuf[0])
+        if len(self._rbuf) < hsize:
+            return False
+        return len(self._rbuf) >= hsize + self.parse_header(bytes(self._rbuf[:hsize]))[2]
 
-        while size:
-            rsize = self._sock.recv_into(mv, size)
-            if rsize == 0:
-                raise ConnectionError("[ERROR] Socket closed while receiving data")
-            
-            mv = mv[rsize:]
-            size -= rsize
-            total_received += rsize
-            print(f"[DEBUG] Received {rsize} bytes, Total: {total_received}/{len(data)}")
-        
-        return data
+    def fileno(self) -> int:
+        """
+        The socket's file descriptor, so a PDU can be passed to select()
+        to check for frames pushed by the server.
+        """
+        return self._sock.fileno()
 
+    @staticmethod
+    def header_size(first_byte: int) -> int:
+        """
+        Returns the full header length given the first byte of a frame.
+        """
+        if first_byte == FRAME_V1:
+            return V1_HEADER.size
+        if 0x30 <= first_byte <= 0x39:
+            return LEGACY_HEADER_SIZE
+        raise ValueError(f"Unknown frame header byte: {first_byte:#04x}")
 
-    def send_message(self, message: CSmessage):
+    @staticmethod
+    def parse_header(header: bytes):
         """
-        Marshals and sends a message over the socket.
+        Returns (frame_version, flags, body_size) for a complete frame header.
+        """
+        if header[0] == FRAME_V1:
+            version, flags, size = V1_HEADER.unpack(header)
+            if flags & ~KNOWN_FLAGS:
+                raise ValueError(f"Unsupported frame flags: {flags:#04x}")
+            return version, flags, size
+        return FRAME_LEGACY, 0, int(header.decode('utf-8'))
+
+    @staticmethod
+    def pack(message: CSmessage, frame_version: int = FRAME_LEGACY, codec: str = CODEC_TEXT) -> bytes:
         """
+        Marshals a message into a complete frame (header and body).
+        """
+        if codec == CODEC_BINARY:
+            if frame_version != FRAME_V1:
+                raise ValueError("The binary codec needs V1 frames")
+            body = message.marshal_binary()
+            return V1_HEADER.pack(FRAME_V1, FLAG_BINARY_CODEC, len(body)) + body
+
         mdata = message.marshal()
-        size = len(mdata)
-        sdata = '{:04}{}'.format(size, mdata)
+        body = mdata.encode('utf-8')
+        size = len(body)
 
-        print(f"[DEBUG] Sending message: size={size}, content={sdata}")  # Debugging
+        print(f"[DEBUG] Sending message: size={size}, content={mdata}")  # Debugging
 
-        self._sock.sendall(sdata.encode('utf-8'))
+        if frame_version == FRAME_V1:
+            return V1_HEADER.pack(FRAME_V1, 0, size) + body
+        if size > LEGACY_MAX_SIZE:
+            raise ValueError(f"Message of {size} bytes does not fit a legacy frame")
+        return b'%04d' % size + body
+
+    @staticmethod
+    def unpack(body: bytes, flags: int = 0) -> CSmessage:
+        """
+        Unmarshals a frame body into a message.
+        """
+        m = CSmessage()
+        if flags & FLAG_BINARY_CODEC:
+            m.unmarshal_binary(body)
+            return m
+
+        params = body.decode('utf-8')
+        print(f"[DEBUG] Raw message data received: {params}")  # Debugging
+
+        m.unmarshal(params)
+        return m
+
+    @classmethod
+    def take_frame(cls, buffer: bytearray):
+        """
+        Removes one complete frame from a receive buffer and returns
+        (frame_version, flags, body), or None if the buffer still holds
+        only part of a frame.
+        """
+        if not buffer:
+            return None
+        hsize = cls.header_size(buffer[0])
+        if len(buffer) < hsize:
+            return None
+        version, flags, size = cls.parse_header(bytes(buffer[:hsize]))
+        end = hsize + size
+        if len(buffer) < end:
+            return None
+        body = bytes(buffer[hsize:end])
+        del buffer[:end]
+        return version, flags, body
+
+    def send_message(self, message: CSmessage):
+        """
+        Marshals and sends a message over the socket.
+        """
+        self._sock.sendall(self.pack(message, self.frame_version, self.codec))
+
+    def send_messages(self, messages):
+        """
+        Marshals several messages and sends them with a single write.
+        """
+        self._sock.sendall(b''.join(self.pack(m, self.frame_version, self.codec) for m in messages))
 
     def receive_message(self) -> CSmessage:
         """
@@ -61,16 +184,17 @@ class SmartHomePDU:
         """
         try:
             print("[DEBUG] Waiting to receive message...")  # Debugging
-            m = CSmessage()
-            
-            size_data = self._loop_recv(4).decode('utf-8')  # Read the first 4 bytes (size)
-            size = int(size_data)
-            print(f"[DEBUG] Message size header received: {size}")  # Debugging
-            
-            params = self._loop_recv(size).decode('utf-8')  # Read the message body
-            print(f"[DEBUG] Raw message data received: {params}")  # Debugging
+            frame = self.take_frame(self._rbuf)
+            while frame is None:
+                self._fill()
+                frame = self.take_frame(self._rbuf)
+            version, flags, body = frame
+            print(f"[DEBUG] Message size header received: {len(body)}")  # Debugging
             
-            m.unmarshal(params)
+            m = self.unpack(body, flags)  # Decode the message body
+            # Answer in the format the peer is using
+            self.frame_version = version
+            self.codec = CODEC_BINARY if flags & FLAG_BINARY_CODEC else CODEC_TEXT
 
         except Exception as e:
             print(f"[ERROR] Error receiving message: {e}")
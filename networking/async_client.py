@@ -0,0 +1,216 @@
+import sys
+import os
+import asyncio
+import itertools
+from typing import Optional
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from messaging.csmessage import CSmessage, REQS, CODEC_TEXT, CODEC_BINARY
+from messaging.cspdu import SmartHomePDU as CSpdu, FRAME_V1, FLAG_BINARY_CODEC
+from networking.smart_home_client import (SmartHomeError, HOST, PORT, build_message, login_message,
+                                          check_response)
+
+# Connections a client opens at most; requests beyond that are pipelined on them
+CONNECTIONS = 2
+
+_request_ids = itertools.count(1)
+
+class AsyncConnection:
+    """
+    One logged-in connection over asyncio streams. Requests are pipelined:
+    each is tagged with a request ID and written straight away, and a reader
+    task hands every response to the request with the same ID, so many
+    coroutines can wait on one connection at once.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        # Responses are sent in the format the server last answered in
+        self.codec = CODEC_TEXT
+        self.pending = {}
+        self.closed = False
+        self._reader_task = asyncio.create_task(self._read_responses())
+
+    @classmethod
+    async def open(cls, host, port, username, password, timeout):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        conn = cls(reader, writer)
+        try:
+            response = await conn.request(login_message(username, password), timeout)
+        except BaseException:
+            await conn.close()
+            raise
+        if response.getValue("status") != "Login successful":
+            await conn.close()
+            raise SmartHomeError(response.getValue("status"), f"Login failed for user '{username}'")
+        return conn
+
+    async def request(self, msg, timeout):
+        """Sends msg and waits for its response"""
+        if self.closed:
+            raise ConnectionError("Connection closed")
+        req_id = next(_request_ids)
+        msg.setRequestId(req_id)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[req_id] = future
+        try:
+            self.writer.write(CSpdu.pack(msg, FRAME_V1, self.codec))
+            await self.writer.drain()
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(req_id, None)
+
+    async def close(self, goodbye=False):
+        if goodbye and not self.closed:
+            msg = CSmessage()
+            msg.setType(REQS.EXIT)
+            try:
+                await self.request(msg, 1.0)
+            except Exception:
+                pass
+        self.closed = True
+        self._reader_task.cancel()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+    async def _read_responses(self):
+        try:
+            while True:
+                first = await self.reader.readexactly(1)
+                header = first + await self.reader.readexactly(CSpdu.header_size(first[0]) - 1)
+                _, flags, size = CSpdu.parse_header(header)
+                response = CSpdu.unpack(await self.reader.readexactly(size), flags)
+                self.codec = CODEC_BINARY if flags & FLAG_BINARY_CODEC else CODEC_TEXT
+                # Notifications carry no request ID and answer nothing
+                future = self.pending.get(response.getRequestId())
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except asyncio.CancelledError:
+            error = "closed"
+        except Exception as e:
+            error = e
+        self.closed = True
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"Connection lost: {error}"))
+
+class AsyncSmartHomeClient:
+    """
+    asyncio counterpart of SmartHomeClient, for services that drive many
+    homes from one event loop. Each client opens up to connections
+    logged-in connections to its server and spreads requests over them,
+    pipelining when every connection is busy. Commands for several homes
+    run concurrently by gathering them:
+
+        async with AsyncSmartHomeClient("admin", "1234", host=host) as home:
+            await home.change_status("Kitchen", "kitchen_light1", "on")
+
+    Requests the server refuses raise SmartHomeError. Connections the
+    server has closed, say because it restarted, are left out before a
+    request is sent, and new ones are opened. A request whose connection
+    fails once it has been written raises ConnectionError instead of being
+    sent again, since it may have been applied. The list_*, change_status
+    and alarm methods return what SmartHomeClient's do.
+    """
+
+    def __init__(self, username: str, password: str, host: str = HOST, port: int = PORT,
+                 connections: int = CONNECTIONS, timeout: float = 10.0):
+        self.username = username
+        self.password = password
+        self.host = host
+        self.port = port
+        self.max_connections = connections
+        self.timeout = timeout
+        self._connections = []
+        self._opening = None
+        self._closed = False
+
+    async def __aenter__(self):
+        await self.login()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+        return False
+
+    async def login(self) -> None:
+        """Checks the credentials by opening the first connection"""
+        await self._connection()
+
+    async def list_room(self, room: str) -> dict:
+        return await self._list(filter_type="room", room=room)
+
+    async def list_group(self, group: str) -> dict:
+        return await self._list(filter_type="group", group=group)
+
+    async def list_device(self, device: str) -> dict:
+        return await self._list(filter_type="device", device=device)
+
+    async def list_all(self) -> dict:
+        return await self._list(filter_type="all", room="all")
+
+    async def change_status(self, room: str, device: str, status: str, pin: Optional[str] = None,
+                            brightness: Optional[int] = None, color: Optional[str] = None) -> str:
+        return await self._change(room=room, device=device, status=status, pin=pin,
+                                  brightness=brightness, color=color)
+
+    async def arm_alarm(self, pin: str) -> str:
+        return await self._change(device="house_alarm", status="armed", pin=pin)
+
+    async def disarm_alarm(self, pin: str) -> str:
+        return await self._change(device="house_alarm", status="disarmed", pin=pin)
+
+    async def close(self) -> None:
+        """Says EXIT on every connection and closes it"""
+        self._closed = True
+        connections, self._connections = self._connections, []
+        await asyncio.gather(*(conn.close(goodbye=True) for conn in connections))
+
+    async def request(self, msg_type: REQS, **values) -> CSmessage:
+        """Sends one request and returns the response"""
+        msg = build_message(msg_type, values)
+        # Only open connections are handed out, and request() writes without
+        # awaiting first, so a failure here may come after the server got msg
+        conn = await self._connection()
+        try:
+            return await conn.request(msg, self.timeout)
+        except ConnectionError:
+            if conn in self._connections:
+                self._connections.remove(conn)
+            raise
+
+    async def _list(self, **values):
+        return check_response(await self.request(REQS.LIST, **values)).getValue("devices")
+
+    async def _change(self, **values):
+        return check_response(await self.request(REQS.CHG_STATUS, **values)).getValue("message")
+
+    async def _connection(self):
+        """
+        Returns the least busy open connection, or a new one if all are
+        busy and there is room for another
+        """
+        if self._closed:
+            raise SmartHomeError("Closed", "The client has been closed")
+        self._connections = [conn for conn in self._connections if not conn.closed]
+        idle = min(self._connections, key=lambda conn: len(conn.pending), default=None)
+        if idle is not None and (not idle.pending or len(self._connections) >= self.max_connections):
+            return idle
+        if self._opening is None:
+            # One connection is opened at a time; concurrent callers wait for it
+            self._opening = asyncio.ensure_future(
+                AsyncConnection.open(self.host, self.port, self.username, self.password, self.timeout))
+        opening = self._opening
+        try:
+            conn = await asyncio.shield(opening)
+        finally:
+            if self._opening is opening and opening.done():
+                self._opening = None
+        if conn not in self._connections:
+            self._connections.append(conn)
+        return conn
@@ -3,15 +3,108 @@ import time
 import getpass
 import sys
 import os
-import json
+import select
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 from messaging.csmessage import CSmessage, REQS
-from messaging.cspdu import SmartHomePDU as CSpdu
+from messaging.cspdu import SmartHomePDU as CSpdu, FRAME_V1
+from networking.smart_home_client import login_message
 
 HOST = "127.0.0.1"
 PORT = 5000
+# Devices per LIST page when showing the whole home
+PAGE_SIZE = 50
+# Seconds the device mirror is trusted without notifications before it asks what changed
+MIRROR_TTL = 5.0
+
+class DeviceMirror:
+    """
+    Local copy of the home's device state, shaped like a LIST result, for
+    the menus and the "already on/off" checks. It is filled once after
+    login and then kept current by change notifications, which are applied
+    whenever the connection is read. If the server cannot push, or had to
+    drop notifications, the mirror catches up with a LIST since the last
+    version it saw, at most once per ttl seconds.
+    Every request on the connection must go through request(), so pushed
+    notifications are never mistaken for responses.
+    """
+
+    def __init__(self, pdu, ttl=MIRROR_TTL):
+        self.pdu = pdu
+        self.ttl = ttl
+        self.devices = {}
+        self.version = None
+        self.subscribed = False
+        # Version to catch up from after the server dropped notifications
+        self._resync_from = None
+        self._checked = 0.0
+
+    def load(self):
+        """Subscribes to every change, then fills the mirror with one full LIST"""
+        msg = CSmessage()
+        msg.setType(REQS.SUBSCRIBE)
+        self.subscribed = self.request(msg).getValue("status") == "Success"
+
+        msg = CSmessage()
+        msg.setType(REQS.LIST)
+        msg.addValue("room", "all")
+        msg.addValue("filter_type", "all")
+        response = self.request(msg)
+        if response.getValue("status") == "Success":
+            self.devices = response.getValue("devices")
+            self.version = int(response.getValue("version") or 0)
+            self._checked = time.monotonic()
+
+    def request(self, msg):
+        """Sends a request and returns its response, applying notifications that arrive first"""
+        self.pdu.send_message(msg)
+        while True:
+            response = self.pdu.receive_message()
+            if response.getType() != REQS.NOTIFY:
+                return response
+            self._notified(response)
+
+    def current(self):
+        """Returns the mirrored devices after applying whatever changed since they were read"""
+        # Notifications the server has already pushed
+        while self.pdu.has_buffered_frame() or select.select([self.pdu], [], [], 0)[0]:
+            self._notified(self.pdu.receive_message())
+        if self.version is None:
+            self.load()
+        elif self._resync_from is not None or (not self.subscribed and time.monotonic() - self._checked >= self.ttl):
+            self._catch_up()
+        return self.devices
+
+    def device(self, room, device):
+        """The mirrored state of one device, or None if it is unknown"""
+        return self.current().get(room, {}).get("devices", {}).get(device)
+
+    def _notified(self, msg):
+        if msg.getValue("status") == "Overflow":
+            since = int(msg.getValue("version"))
+            self._resync_from = since if self._resync_from is None else min(since, self._resync_from)
+        elif msg.getValue("status") == "Update":
+            self._merge(msg.getValue("devices"), int(msg.getValue("version")))
+
+    def _catch_up(self):
+        msg = CSmessage()
+        msg.setType(REQS.LIST)
+        msg.addValue("filter_type", "all")
+        msg.addValue("since", self.version if self._resync_from is None else min(self.version, self._resync_from))
+        response = self.request(msg)
+        if response.getValue("status") != "Success":
+            return
+        self._resync_from = None
+        self._checked = time.monotonic()
+        for removed in response.getValue("removed") or []:
+            self.devices.get(removed["room"], {}).get("devices", {}).pop(removed["device"], None)
+        self._merge(response.getValue("devices"), int(response.getValue("version")))
+
+    def _merge(self, devices, version):
+        for room, room_info in devices.items():
+            self.devices.setdefault(room, {"devices": {}})["devices"].update(room_info["devices"])
+        self.version = max(self.version or 0, version)
 
 def display_device_info(devices, message=None):
     """Helper function to display device information in a formatted way"""
@@ -24,13 +117,10 @@ def display_device_info(devices, message=None):
         print("No devices found or unauthorized access")
         return
         
-    # Check if devices is a string and try to parse it
-    if isinstance(devices, str):
-        try:
-            devices = json.loads(devices.replace("'", '"'))
-        except json.JSONDecodeError:
-            print("[ERROR] Failed to parse device information")
-            return
+    # Device trees arrive already decoded by CSmessage
+    if not isinstance(devices, dict):
+        print("[ERROR] Failed to parse device information")
+        return
             
     print("\nDevice Status:")
     
@@ -87,28 +177,13 @@ def display_device_info(devices, message=None):
         else:
             print("  No devices found in this room\n")
 
-def handle_window_blind(pdu, room, device, current_status=None):
+def handle_window_blind(mirror, room, device, current_status=None):
     """Special handler for window blind operations"""
     # Get current status if not provided
     if current_status is None:
-        msg = CSmessage()
-        msg.setType(REQS.LIST)
-        msg.addValue("room", room)
-        msg.addValue("device", device)
-        msg.addValue("filter_type", "device")
-        
-        print("\n[DEBUG] Getting current window blind status...")
-        pdu.send_message(msg)
-        
-        response = pdu.receive_message()
-        
-        if response and response.getValue("status") == "Success":
-            devices = response.getValue("devices")
-            if isinstance(devices, str):
-                devices = json.loads(devices.replace("'", '"'))
-            
-            if room in devices and "devices" in devices[room] and device in devices[room]["devices"]:
-                current_status = devices[room]["devices"][device].get("status", "unknown")
+        device_info = mirror.device(room, device)
+        if device_info:
+            current_status = device_info.get("status", "unknown")
     
     print("\nWindow Blind Controls:")
     print(f"Current status: {current_status}")
@@ -151,10 +226,8 @@ def handle_window_blind(pdu, room, device, current_status=None):
     msg.addValue("status", status)
     
     print(f"\n[DEBUG] Sending CHG_STATUS request: {msg.marshal()}")
-    pdu.send_message(msg)
-    
     print("[DEBUG] Waiting for server response...")
-    response = pdu.receive_message()
+    response = mirror.request(msg)
     print(f"[DEBUG] Received response: {response.marshal()}")
     
     if response:
@@ -167,7 +240,7 @@ def handle_window_blind(pdu, room, device, current_status=None):
         else:
             print(f"\n✓ Success: {message}")
 
-def handle_light(pdu, room, device, current_status=None, current_brightness=None, current_color=None):
+def handle_light(mirror, room, device, current_status=None, current_brightness=None, current_color=None):
     """Special handler for light operations"""
     print("\nLight Controls:")
     print(f"Current status: {current_status}")
@@ -248,10 +321,8 @@ def handle_light(pdu, room, device, current_status=None, current_brightness=None
         return
     
     print(f"\n[DEBUG] Sending CHG_STATUS request: {msg.marshal()}")
-    pdu.send_message(msg)
-    
     print("[DEBUG] Waiting for server response...")
-    response = pdu.receive_message()
+    response = mirror.request(msg)
     print(f"[DEBUG] Received response: {response.marshal()}")
     
     if response:
@@ -265,26 +336,12 @@ def handle_light(pdu, room, device, current_status=None, current_brightness=None
         else:
             print(f"\n✓ Success: {message}")
 
-def handle_house_alarm(pdu):
+def handle_house_alarm(mirror):
     """Special handler for house alarm operations"""
-    # First get current status
-    msg = CSmessage()
-    msg.setType(REQS.LIST)
-    msg.addValue("device", "house_alarm")
-    
-    print("\n[DEBUG] Getting current house alarm status...")
-    pdu.send_message(msg)
-    
-    response = pdu.receive_message()
-    
     current_status = "unknown"
-    if response and response.getValue("status") == "Success":
-        devices = response.getValue("devices")
-        if isinstance(devices, str):
-            devices = json.loads(devices.replace("'", '"'))
-        
-        if "Home" in devices and "devices" in devices["Home"] and "house_alarm" in devices["Home"]["devices"]:
-            current_status = devices["Home"]["devices"]["house_alarm"].get("status", "unknown")
+    house_alarm = mirror.device("Home", "house_alarm")
+    if house_alarm:
+        current_status = house_alarm.get("status", "unknown")
     
     print("\nHouse Alarm Controls:")
     print(f"Current status: {current_status}")
@@ -317,10 +374,8 @@ def handle_house_alarm(pdu):
     msg.addValue("pin", pin)
     
     print(f"\n[DEBUG] Sending CHG_STATUS request: {msg.marshal()}")
-    pdu.send_message(msg)
-    
     print("[DEBUG] Waiting for server response...")
-    response = pdu.receive_message()
+    response = mirror.request(msg)
     print(f"[DEBUG] Received response: {response.marshal()}")
     
     if response:
@@ -403,7 +458,7 @@ def main():
         client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         client.settimeout(10)
         client.connect((HOST, PORT))
-        pdu = CSpdu(client)
+        pdu = CSpdu(client, FRAME_V1)
         print(r"""
         ╔════════════════════════════════════════════╗
         ║             SMART HOME SYSTEM              ║
@@ -425,10 +480,7 @@ def main():
             username = input("Enter username: ")
             password = masked_input("Enter password: ")
             
-            login_msg = CSmessage()
-            login_msg.setType(REQS.LGIN)
-            login_msg.addValue("username", username)
-            login_msg.addValue("password", password)
+            login_msg = login_message(username, password)
             
             print(f"\n[DEBUG] Sending login request: {login_msg.marshal()}")
             pdu.send_message(login_msg)
@@ -438,6 +490,9 @@ def main():
             
             if response and response.getValue("status") == "Login successful":
                 print("Login successful!")
+                # Device state for the menus, kept current by the server from here on
+                mirror = DeviceMirror(pdu)
+                mirror.load()
                 
                 # User session loop
                 user_active = True
@@ -481,49 +536,41 @@ def main():
                         elif list_choice == "4":  # All Devices
                             msg.addValue("room", "all")
                             msg.addValue("filter_type", "all")
+                            msg.addValue("page_size", PAGE_SIZE)
                         else:
                             print("Invalid option")
                             continue
                         
-                        print(f"\n[DEBUG] Sending LIST request: {msg.marshal()}")
-                        pdu.send_message(msg)
-                        
-                        # Client-side LIST request handler
-                        print("[DEBUG] Waiting for server response...")
-                        response = pdu.receive_message()
-                        print(f"[DEBUG] Received response: {response.marshal()}")
+                        # Paginated listings are shown page by page as they arrive
+                        while True:
+                            print(f"\n[DEBUG] Sending LIST request: {msg.marshal()}")
+                            
+                            # Client-side LIST request handler
+                            print("[DEBUG] Waiting for server response...")
+                            response = mirror.request(msg)
+                            print(f"[DEBUG] Received response: {response.marshal()}")
 
-                        if response:
+                            if not response:
+                                break
                             status = response.getValue("status")
                             if status == "Error":
                                 message = response.getValue("message")
                                 print(f"\nError: {message}")
-                            else:
-                                devices = response.getValue("devices")
-                                display_device_info(devices)
+                                break
+                            devices = response.getValue("devices")
+                            display_device_info(devices)
+
+                            next_cursor = response.getValue("next_cursor")
+                            if next_cursor is None:
+                                break
+                            msg.addValue("cursor", next_cursor)
                     
                     elif choice == "2":
-                        # First, get the room list
-                        room_msg = CSmessage()
-                        room_msg.setType(REQS.LIST)
-                        room_msg.addValue("room", "all")
-                        room_msg.addValue("filter_type", "all")
-                        
-                        print(f"\n[DEBUG] Fetching available rooms and devices...")
-                        pdu.send_message(room_msg)
-                        
-                        room_response = pdu.receive_message()
+                        # Rooms and devices come from the mirror, without a round-trip
+                        devices_data = mirror.current()
                         
                         # Display available rooms
-                        if room_response:
-                            devices_data = room_response.getValue("devices")
-                            if isinstance(devices_data, str):
-                                try:
-                                    devices_data = json.loads(devices_data.replace("'", '"'))
-                                except:
-                                    print("[ERROR] Failed to parse device information")
-                                    continue
-                                    
+                        if devices_data:
                             print("\nAvailable Rooms:")
                             for i, room in enumerate([r for r in devices_data.keys() if r != "Home"], 1):
                                 print(f"{i}. {room}")   
@@ -539,7 +586,7 @@ def main():
                             # Check if user selected the house alarm
                             if room_idx.lower() == "h":
                                 print(f"Selected: House Alarm")
-                                handle_house_alarm(pdu)
+                                handle_house_alarm(mirror)
                                 continue
                             
                             try:
@@ -576,9 +623,9 @@ def main():
                                     
                                     # Special handling based on device type
                                     if device_type == "WindowBlind":
-                                        handle_window_blind(pdu, room_name, device_name, current_status)
+                                        handle_window_blind(mirror, room_name, device_name, current_status)
                                     elif device_type == "Light":
-                                        handle_light(pdu, room_name, device_name, current_status, current_brightness, current_color)
+                                        handle_light(mirror, room_name, device_name, current_status, current_brightness, current_color)
                                     elif device_type == "Lock":
                                         # Special handling for locks with PIN verification
                                         lock_option = input("\nLock Controls:\n1. Lock\n2. Unlock\nChoose an option: ")
@@ -602,10 +649,8 @@ def main():
                                         msg.addValue("pin", pin)
                                         
                                         print(f"\n[DEBUG] Sending CHG_STATUS request: {msg.marshal()}")
-                                        pdu.send_message(msg)
-                                        
                                         print("[DEBUG] Waiting for server response...")
-                                        response = pdu.receive_message()
+                                        response = mirror.request(msg)
                                         print(f"[DEBUG] Received response: {response.marshal()}")
                                         
                                         if response:
@@ -629,10 +674,8 @@ def main():
                                             msg.addValue("pin", pin)
                                         
                                         print(f"\n[DEBUG] Sending CHG_STATUS request: {msg.marshal()}")
-                                        pdu.send_message(msg)
-                                        
                                         print("[DEBUG] Waiting for server response...")
-                                        response = pdu.receive_message()
+                                        response = mirror.request(msg)
                                         print(f"[DEBUG] Received response: {response.marshal()}")
                                         
                                         if response:
@@ -649,26 +692,10 @@ def main():
                     
                     elif choice == "3":  # Add new device
                         # First, get rooms
-                        room_msg = CSmessage()
-                        room_msg.setType(REQS.LIST)
-                        room_msg.addValue("room", "all")
-                        room_msg.addValue("filter_type", "all")
-                        
-                        print(f"\n[DEBUG] Fetching available rooms...")
-                        pdu.send_message(room_msg)
-                        
-                        room_response = pdu.receive_message()
+                        devices_data = mirror.current()
                         
                         # Display available rooms
-                        if room_response:
-                            devices_data = room_response.getValue("devices")
-                            if isinstance(devices_data, str):
-                                try:
-                                    devices_data = json.loads(devices_data.replace("'", '"'))
-                                except:
-                                    print("[ERROR] Failed to parse device information")
-                                    continue
-                                    
+                        if devices_data:
                             print("\nAvailable Rooms:")
                             for i, room in enumerate(devices_data.keys(), 1):
                                 print(f"{i}. {room}")
@@ -706,9 +733,7 @@ def main():
                                     
                                     # Send the request
                                     print(f"\n[DEBUG] Sending ADD_DEVICE request...")
-                                    pdu.send_message(msg)
-                                    
-                                    response = pdu.receive_message()
+                                    response = mirror.request(msg)
                                     
                                     if response:
                                         status = response.getValue("status") 
@@ -725,9 +750,7 @@ def main():
                         msg.setType(REQS.LOUT)
                         
                         print(f"\n[DEBUG] Sending LOUT request: {msg.marshal()}")
-                        pdu.send_message(msg)
-                        
-                        response = pdu.receive_message()
+                        response = mirror.request(msg)
                         print(f"[DEBUG] Received response: {response.marshal()}")
                         
                         print("Logged out successfully")
@@ -738,9 +761,7 @@ def main():
                         msg.setType(REQS.EXIT)
                         
                         print(f"\n[DEBUG] Sending EXIT request: {msg.marshal()}")
-                        pdu.send_message(msg)
-                        
-                        response = pdu.receive_message()
+                        response = mirror.request(msg)
                         print(f"[DEBUG] Received response: {response.marshal()}")
                         
                         print("Exiting...")
@@ -0,0 +1,45 @@
+import threading
+from collections import OrderedDict
+
+class ListCache:
+    """
+    Encoded LIST results keyed by filter: ("room", name), ("group", name),
+    ("device", name) or ("all", None). Each entry remembers the version it
+    was built at, and is only served while that version is still current.
+    Room entries follow their room's version, so a change elsewhere in the
+    home leaves them valid; every other filter can span rooms and follows
+    the global version. Least recently used entries are dropped once
+    max_entries is reached.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def version_of(key, version, room_versions):
+        """The version an entry for key must carry to be current"""
+        if key[0] == "room":
+            return room_versions.get(key[1], 0)
+        return version
+
+    def get(self, key, current):
+        """Returns the cached value for key if it was built at version current"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != current:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, built_at, value):
+        with self._lock:
+            self._entries[key] = (built_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
@@ -0,0 +1,247 @@
+import threading
+from collections import deque
+from messaging.csmessage import CSmessage, REQS
+from messaging.cspdu import SmartHomePDU as CSpdu
+
+# Notification bytes a subscriber may have waiting to be sent. Past this the
+# subscriber is a slow consumer: further notifications are dropped and it
+# is told which version to resync from with LIST since.
+NOTIFY_BUFFER_LIMIT = 256 * 1024
+
+class Subscriber:
+    """
+    The subscriptions of one client session and the channel that pushes
+    NOTIFY frames to it. Subclasses say how frames reach the socket in each
+    server mode.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        # sub_id -> (room, group, device) filter; None fields match anything.
+        # Replaced, never modified, so matches() can read it while the hub
+        # subscribes and unsubscribes
+        self.filters = {}
+        self.delivered = 0
+        self.dropped = 0
+        # Set once the client has been told it is missing notifications
+        self._overflowed = False
+        # Oldest version dropped since then, which that notice may not cover
+        self._missed_since = None
+        self._lock = threading.Lock()
+
+    def matches(self, room_name, device_name, device):
+        for room, group, name in self.filters.values():
+            if room is not None and room != room_name:
+                continue
+            if name is not None and name != device_name:
+                continue
+            if group is not None and group.lower() != str(device.get("type", "")).lower() \
+                    and group.lower() not in device.get("groups", []):
+                continue
+            return True
+        return False
+
+    def offer(self, devices, version):
+        """
+        Queues a notification. While too much is pending it is dropped
+        instead: the first drop queues an Overflow notice, and drops after
+        that are reported by another notice once the backlog has drained.
+        """
+        with self._lock:
+            if self.pending() > NOTIFY_BUFFER_LIMIT:
+                self.dropped += 1
+                if not self._overflowed:
+                    self._overflowed = True
+                    self.send(self.pack(self._overflow(version)))
+                elif self._missed_since is None or version < self._missed_since:
+                    self._missed_since = version
+                return
+            if self._missed_since is not None:
+                self.send(self.pack(self._overflow(self._missed_since)))
+                self._missed_since = None
+            self._overflowed = False
+            update = CSmessage()
+            update.setType(REQS.NOTIFY)
+            update.addValue("status", "Update")
+            update.addValue("devices", devices)
+            update.addValue("version", version)
+            try:
+                frame = self.pack(update)
+            except ValueError:
+                # Too large for the session's legacy frames; it can still resync
+                frame = self.pack(self._overflow(version))
+            self.send(frame)
+            self.delivered += 1
+
+    @staticmethod
+    def _overflow(version):
+        notice = CSmessage()
+        notice.setType(REQS.NOTIFY)
+        notice.addValue("status", "Overflow")
+        notice.addValue("message", "Notifications were dropped, resync with LIST since version")
+        # Changes after this version may have been missed
+        notice.addValue("version", version - 1)
+        return notice
+
+    def pack(self, message):
+        return CSpdu.pack(message, self.session.frame_version, self.session.codec)
+
+    def pending(self):
+        """Notification bytes waiting to be sent"""
+        raise NotImplementedError
+
+    def send(self, frame):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class ThreadedSubscriber(Subscriber):
+    """
+    Pushes from a thread of its own, so a slow client only ever blocks that
+    thread. send_lock is shared with the connection's response writes so
+    frames never interleave.
+    """
+
+    def __init__(self, session, sock, send_lock):
+        super().__init__(session)
+        self._sock = sock
+        self._send_lock = send_lock
+        self._queue = deque()
+        self._queued = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="notify", daemon=True)
+        self._thread.start()
+
+    def pending(self):
+        return self._queued
+
+    def send(self, frame):
+        with self._cond:
+            self._queue.append(frame)
+            self._queued += len(frame)
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                frames = list(self._queue)
+                self._queue.clear()
+            try:
+                with self._send_lock:
+                    self._sock.sendall(b"".join(frames))
+            except OSError:
+                return
+            finally:
+                with self._cond:
+                    self._queued -= sum(len(frame) for frame in frames)
+
+class StreamSubscriber(Subscriber):
+    """Pushes through an asyncio StreamWriter; only used from the event loop thread"""
+
+    def __init__(self, session, writer):
+        super().__init__(session)
+        self._writer = writer
+
+    def pending(self):
+        return self._writer.transport.get_write_buffer_size()
+
+    def send(self, frame):
+        self._writer.write(frame)
+
+class BufferSubscriber(Subscriber):
+    """
+    Pushes into a reactor connection's output buffer; only used from the
+    reactor thread, which is told through wake() to flush it.
+    """
+
+    def __init__(self, session, conn, wake):
+        super().__init__(session)
+        self._conn = conn
+        self._wake = wake
+
+    def pending(self):
+        return len(self._conn.outbuf)
+
+    def send(self, frame):
+        self._conn.outbuf += frame
+        self._wake(self._conn)
+
+class SubscriptionHub:
+    """Routes committed changes to the sessions subscribed to them"""
+
+    def __init__(self):
+        self._subscribers = {}
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def subscribe(self, session, make_subscriber, room=None, group=None, device=None):
+        """Adds a filter for session, creating its Subscriber on first use; returns the sub_id"""
+        with self._lock:
+            subscriber = self._subscribers.get(session)
+            if subscriber is None:
+                subscriber = self._subscribers[session] = make_subscriber()
+            sub_id = self._next_id
+            self._next_id += 1
+            subscriber.filters = {**subscriber.filters, sub_id: (room, group, device)}
+            return sub_id
+
+    def unsubscribe(self, session, sub_id=None):
+        """Drops one filter, or all of them; returns how many were dropped"""
+        with self._lock:
+            subscriber = self._subscribers.get(session)
+            if subscriber is None:
+                return 0
+            filters = subscriber.filters
+            if sub_id is None:
+                dropped = len(filters)
+                subscriber.filters = {}
+            else:
+                dropped = 1 if sub_id in filters else 0
+                subscriber.filters = {key: value for key, value in filters.items() if key != sub_id}
+            if not subscriber.filters:
+                del self._subscribers[session]
+                subscriber.close()
+            return dropped
+
+    def remove(self, session):
+        """Forgets a session that has disconnected"""
+        with self._lock:
+            subscriber = self._subscribers.pop(session, None)
+        if subscriber is not None:
+            subscriber.close()
+
+    def publish(self, keys, lookup, version):
+        """
+        Notifies subscribers about the (room, device) keys changed in
+        version. lookup(key) returns a device's state after the change.
+        """
+        with self._lock:
+            subscribers = list(self._subscribers.values())
+        if not subscribers:
+            return
+        changed = [(key, lookup(key)) for key in keys]
+        for subscriber in subscribers:
+            devices = {}
+            for (room_name, device_name), device in changed:
+                if device is not None and subscriber.matches(room_name, device_name, device):
+                    devices.setdefault(room_name, {"devices": {}})["devices"][device_name] = device
+            if devices:
+                try:
+                    subscriber.offer(devices, version)
+                except Exception as e:
+                    # The change is committed either way; a broken subscriber must not fail it
+                    print(f"[ERROR] Failed to notify {subscriber.session.addr}: {e}")
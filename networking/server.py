@@ -1,38 +1,261 @@
 import sys
 import os
-import json
 import socket
+import asyncio
+import selectors
+import argparse
+import functools
+import itertools
+import threading
+import signal
+import time
+import multiprocessing
+from collections import deque
+from multiprocessing.managers import BaseManager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
-from messaging.csmessage import CSmessage, REQS
-from messaging.cspdu import SmartHomePDU as CSpdu
+from messaging.csmessage import CSmessage, REQS, CODEC_TEXT, CODEC_BINARY, EncodedValue
+from messaging.cspdu import SmartHomePDU as CSpdu, FRAME_LEGACY, FRAME_V1
+from storage.json_store import JSONStore
+from storage.sqlite_store import SQLiteStore
+from storage.device_index import DeviceIndex, HOUSE_ALARM
+from storage.locks import InstrumentedLock, WriteLocks, GRANULARITIES
+from storage.snapshot import Draft
+from networking.list_cache import ListCache
+from networking.pubsub import SubscriptionHub, ThreadedSubscriber, StreamSubscriber, BufferSubscriber
 
 # Define JSON file path
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_FILE = os.path.join(BASE_DIR, "..", "smart_home.json")
 
+HOST = "127.0.0.1"
+PORT = 5000
+MAX_WORKERS = 16
+# Largest page a paginated LIST may ask for
+MAX_PAGE_SIZE = 500
+
+# SRCH request fields, passed to search_devices() by name
+SEARCH_CRITERIA = ("query", "room", "device_type", "status", "color", "group", "min_brightness", "max_brightness")
+
+# Commits the owner remembers for prefork workers to catch up from; a
+# worker that falls further behind fetches a whole snapshot instead
+CHANGE_LOG_SIZE = 1024
+
+# How often a prefork worker asks the owner for changes, to refresh its
+# replica and push them to its subscribers
+NOTIFY_POLL_INTERVAL = 0.1
+
+# Published home document. It is never modified in place: writers build a
+# Draft and publish it by replacing the reference, so a reader that took
+# cached_data keeps a consistent snapshot without holding data_lock.
 cached_data = None
 
+# Persists cached_data; created on first use unless configure_storage() ran first
+store = None
+
+# Type, group and name indexes over cached_data, rebuilt when it is replaced
+device_index = None
+
+# Bumped on every committed change and stamped on the devices it changed,
+# starting from the highest stamp in the stored home. Prefork workers
+# compare it with the owner's to decide when their replica is stale.
+state_version = 0
+
+# Per-room change counters ("Home" for the house alarm), bumped with
+# state_version so cached LISTs of untouched rooms stay valid
+room_versions = {}
+
+# Encoded LIST results, dropped when a prefork replica is replaced
+list_cache = None
+
+# (version, change records) of the latest commits, oldest first
+change_log = deque(maxlen=CHANGE_LOG_SIZE)
+
+# Proxy to the state owner process, set only inside prefork workers
+state_owner = None
+
+# The owner's manager server, set in the prefork parent before it forks
+owner_server = None
+
+# Sessions that asked to be notified of changes, and what about
+subscriptions = SubscriptionHub()
+
+# Home-level lock: serializes publishing snapshots and store maintenance
+# when clients are served concurrently. It is only held briefly.
+data_lock = InstrumentedLock("data", reentrant=True)
+
+# Room or device locks held by writers while they validate and apply a
+# change, so changes to different rooms or devices proceed in parallel
+write_locks = WriteLocks()
+
+# Orders calls into the store, taken after a snapshot has been published.
+# The store's background flusher takes it too, so a compaction never
+# falls between two commits' records.
+persist_lock = InstrumentedLock("persist")
+
+class NullLock:
+    """Stands in for data_lock when a single thread owns cached_data"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+def synchronized(func):
+    """Runs func while holding data_lock"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with data_lock:
+            return func(*args, **kwargs)
+    return wrapper
+
+def owned(func):
+    """Runs func in the state owner process when called from a prefork worker"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if state_owner is not None:
+            result = getattr(state_owner, func.__name__)(*args, **kwargs)
+            # Pull the change into the replica, so the client reads its own write
+            refresh_data()
+            return result
+        return func(*args, **kwargs)
+    return wrapper
+
+def configure_storage(write_behind=False, interval=0.5, max_latency=2.0, journal=False,
+                      compact_threshold=1024 * 1024, database=None):
+    """
+    Selects how changes are persisted; call before the first load_data().
+    With a database path the home lives in SQLite, imported from DATA_FILE
+    the first time, and the JSON options are ignored.
+    """
+    global store
+    if database:
+        store = SQLiteStore(database, DATA_FILE)
+    else:
+        store = JSONStore(DATA_FILE, write_behind, interval, max_latency, journal, compact_threshold)
+    return store
+
+def configure_locks(granularity="device"):
+    """Selects how finely writers lock the home: "home", "room" or "device" """
+    global write_locks
+    write_locks = WriteLocks(granularity)
+    return write_locks
+
+def lock_stats():
+    """Acquisition, contention and timing counters of every lock, for tuning"""
+    stats = {"persist": persist_lock.stats(), "writers": write_locks.stats()}
+    if isinstance(data_lock, InstrumentedLock):
+        stats["data"] = data_lock.stats()
+    return stats
+
+def report_lock_stats(limit=5):
+    """Prints lock totals and the most contended writer locks"""
+    stats = lock_stats()
+    writers = stats["writers"]
+    print(f"[SERVER] Lock granularity: {write_locks.granularity}, writer locks: {len(writers)}, "
+          f"contended: {sum(lock['contended'] for lock in writers.values())}, "
+          f"waited: {sum(lock['wait_ms'] for lock in writers.values()):.3f} ms")
+    for name in ("data", "persist"):
+        if name in stats:
+            print(f"[SERVER] Lock {name}: {stats[name]}")
+    for name, lock in list(writers.items())[:limit]:
+        print(f"[SERVER] Lock {name}: {lock}")
+
+def get_store():
+    global store
+    if store is None:
+        store = JSONStore(DATA_FILE)
+    return store
+
+def start_storage():
+    """Starts the write-behind and compaction thread, if one is configured"""
+    if store is not None and store.needs_thread():
+        store.start(persist_lock)
+
+def close_storage():
+    """Writes any changes the store is still holding"""
+    if store is not None:
+        store.close(persist_lock)
+
 def load_data():
-    global cached_data
-    if cached_data is None:  # Load only once
-        try:
-            with open(DATA_FILE, "r") as file:
-                cached_data = json.load(file)
+    """Returns the current snapshot of the home; it must not be modified"""
+    data = cached_data
+    if data is not None:
+        return data
+    return refresh_data()
+
+def refresh_data():
+    """
+    Loads the home on first use. In a prefork worker it also brings the
+    local replica up to date by replaying the owner's latest commits, or
+    by fetching a whole snapshot if it fell too far behind; the worker's
+    follow_owner() thread and its own changes call it, so reads never wait
+    on the owner.
+    """
+    global cached_data, state_version, list_cache
+    if state_owner is not None:
+        # The round trips to the owner are made without data_lock
+        if cached_data is not None:
+            version, changes = state_owner.changes_since(state_version)
+            if changes is not None:
+                with data_lock:
+                    if version > state_version:
+                        # Another refresh may have applied some of them already
+                        publish_changes([change for change in changes
+                                         if change["fields"]["version"] > state_version], version)
+                return cached_data
+        version, data = state_owner.snapshot()
+        with data_lock:
+            if cached_data is None or version > state_version:
+                # Published before the version, like commit_changes() does
+                cached_data = data
+                list_cache = None
+                state_version = version
+        return cached_data
+    with data_lock:
+        if cached_data is None:  # Load only once
+            cached_data = get_store().load()
+            if cached_data is not None:
                 print("[DEBUG] JSON loaded successfully")
-        except FileNotFoundError:
-            print("[ERROR] JSON file missing, creating a new one.")
-            cached_data = {"users": {}, "home": {"rooms": {}}}
-            save_data()  # Create the file
+                # Carry on numbering from the newest change already stored
+                state_version = max((int(device.get("version", 0)) for _, _, device in iter_devices(cached_data)),
+                                    default=0)
+            else:
+                print("[ERROR] JSON file missing, creating a new one.")
+                cached_data = {"users": {}, "home": {"rooms": {}}}
+                save_data()  # Create the file
     return cached_data
 
+@synchronized
 def save_data():
     global cached_data
     if cached_data:
-        with open(DATA_FILE, "w") as file:
-            json.dump(cached_data, file, indent=4)
-        print("[DEBUG] JSON saved successfully")
+        with persist_lock:
+            get_store().save(cached_data)
+
+@synchronized
+def query_device_index(query):
+    """
+    Runs query against the device index and returns (snapshot, result).
+    The index changes with every commit, so it is only read under data_lock,
+    together with the snapshot it describes.
+    """
+    data = load_data()
+    return data, query(get_device_index(data))
+
+def device_at(data, key):
+    """Looks up a (room, device) index key in a snapshot"""
+    return DeviceIndex.lookup(data, key)
+
+def get_device_index(data):
+    """Returns the indexes for data, rebuilding them if data was replaced; caller holds data_lock"""
+    global device_index
+    if device_index is None or device_index.data is not data:
+        device_index = DeviceIndex(data)
+    return device_index
 
 # Server-side authentication
 def authenticate_user(username, password):
@@ -58,6 +281,8 @@ def verify_pin(device_info, pin):
 def get_device_status(room_name=None, device_name=None, group=None):
     """
     Get device status filtering by room, device, or group.
+    The result shares structure with an immutable snapshot, so it needs no
+    lock and no copy, but it must not be modified.
     """
     data = load_data()
     result = {}
@@ -74,11 +299,11 @@ def get_device_status(room_name=None, device_name=None, group=None):
         
         if room_name and device_name:
             # Get specific device in specific room
-            if room_name in data["home"]["rooms"] and device_name in data["home"]["rooms"][room_name]["devices"]:
-                result[room_name] = {"devices": {device_name: data["home"]["rooms"][room_name]["devices"][device_name]}}
-            # Special case for house_alarm
-            elif room_name == "Home" and device_name == "house_alarm" and house_alarm:
+            # Special case for house_alarm, which wins over any copy in a "Home" room
+            if room_name == "Home" and device_name == "house_alarm" and house_alarm:
                 result["Home"] = {"devices": {"house_alarm": house_alarm}}
+            elif room_name in data["home"]["rooms"] and device_name in data["home"]["rooms"][room_name]["devices"]:
+                result[room_name] = {"devices": {device_name: data["home"]["rooms"][room_name]["devices"][device_name]}}
             else:
                 return {"error": f"Device '{device_name}' not found in room '{room_name}'"}
             
@@ -88,6 +313,11 @@ def get_device_status(room_name=None, device_name=None, group=None):
                 result[room_name] = data["home"]["rooms"][room_name]
                 if not result[room_name].get("devices"):
                     return {"error": f"No devices found in room '{room_name}'"}
+                if room_name == "Home" and house_alarm:
+                    # List the live alarm rather than a copy stored in the room
+                    home = result["Home"] = dict(result["Home"])
+                    home["devices"] = dict(home["devices"])
+                    home["devices"]["house_alarm"] = house_alarm
             # Special case for house_alarm
             elif room_name == "Home" and house_alarm:
                 result["Home"] = {"devices": {"house_alarm": house_alarm}}
@@ -96,54 +326,31 @@ def get_device_status(room_name=None, device_name=None, group=None):
                 
         elif group:
             # Get all devices of a specific group/type
-            found_devices = False
-            for room_name, room in data["home"]["rooms"].items():
-                for device_name, device in room["devices"].items():
-                    if device.get("type", "").lower() == group.lower() or group.lower() in device.get("groups", []):
-                        if room_name not in result:
-                            result[room_name] = {"devices": {}}
-                        result[room_name]["devices"][device_name] = device
-                        found_devices = True
-            
-            # Include house alarm if group matches
-            if house_alarm and (house_alarm.get("type", "").lower() == group.lower() or group.lower() in house_alarm.get("groups", [])):
-                if "Home" not in result:
-                    result["Home"] = {"devices": {}}
-                result["Home"]["devices"]["house_alarm"] = house_alarm
-                found_devices = True
+            data, keys = query_device_index(lambda index: index.group(group))
+            for key in keys:
+                result.setdefault(key[0], {"devices": {}})["devices"][key[1]] = device_at(data, key)
                         
-            if not found_devices:
+            if not result:
                 return {"error": f"No devices found in group '{group}'"}
                 
         elif device_name:
             # Get specific device in any room
-            found_device = False
-            for room_name, room in data["home"]["rooms"].items():
-                if device_name in room["devices"]:
-                    if room_name not in result:
-                        result[room_name] = {"devices": {}}
-                    result[room_name]["devices"][device_name] = room["devices"][device_name]
-                    found_device = True
-            
-            # Include house alarm if name matches
-            if device_name == "house_alarm" and house_alarm:
-                if "Home" not in result:
-                    result["Home"] = {"devices": {}}
-                result["Home"]["devices"]["house_alarm"] = house_alarm
-                found_device = True
+            data, keys = query_device_index(lambda index: index.named(device_name))
+            for key in keys:
+                result.setdefault(key[0], {"devices": {}})["devices"][key[1]] = device_at(data, key)
                     
-            if not found_device:
+            if not result:
                 return {"error": f"Device '{device_name}' not found"}
                     
         else:
-            # Get all devices in all rooms
-            result = data["home"]["rooms"]
+            # Get all devices in all rooms, on a copy of the room table
+            result = dict(data["home"]["rooms"])
             
             # Add house_alarm to results
             if house_alarm:
-                if "Home" not in result:
-                    result["Home"] = {"devices": {}}
-                result["Home"]["devices"]["house_alarm"] = house_alarm
+                home = result["Home"] = dict(result.get("Home", {}))
+                home["devices"] = dict(home.get("devices", {}))
+                home["devices"]["house_alarm"] = house_alarm
                 
             if not result:
                 return {"error": "No devices found"}
@@ -157,10 +364,163 @@ def get_device_status(room_name=None, device_name=None, group=None):
         
     return result
 
-def change_house_alarm_status(new_status, pin=None):
-    """Changes the status of the house alarm"""
+def get_list_cache(key):
+    """
+    Returns the LIST cache, the version a current entry for key carries and
+    the state version. Writers publish a snapshot before bumping the
+    versions, and the versions are read here before the snapshot, so
+    reading them without the lock can only cause a miss, never a stale hit.
+    """
+    global list_cache
+    load_data()
+    cache = list_cache
+    if cache is None:
+        cache = list_cache = ListCache()
+    version = state_version
+    return cache, ListCache.version_of(key, version, room_versions), version
+
+def get_encoded_device_status(key, room_name=None, device_name=None, group=None):
+    """
+    get_device_status() for a LIST filter key, returned as (EncodedValue,
+    version) where the result includes every change up to version. It is
+    served from the LIST cache while nothing it covers has changed; errors
+    are returned as (dict, None) and are never cached.
+    """
+    cache, current, version = get_list_cache(key)
+    entry = cache.get(key, current)
+    if entry is None:
+        # Built from state at least as new as current, so it is never served stale
+        result = get_device_status(room_name, device_name, group)
+        if "error" in result:
+            return result, None
+        entry = (EncodedValue(result), version)
+        cache.put(key, current, entry)
+    return entry
+
+def get_device_changes(since, room_name=None):
+    """
+    Devices changed after state version since, for one room or the whole
+    home, shaped like a LIST result. Returns (result, removed, version):
+    removed lists {"room", "device"} tombstones for devices removed after
+    since, and version is the state version the result is complete up to.
+    """
+    try:
+        since = int(since)
+    except (TypeError, ValueError):
+        return {"error": "Invalid version"}, [], None
+    if since < 0:
+        return {"error": "Invalid version"}, [], None
+
+    data, (keys, removed, version) = query_device_index(
+        lambda index: (index.changed_since(since), index.removed_since(since), state_version))
+    if room_name and room_name not in data["home"]["rooms"] and room_name != "Home":
+        return {"error": f"Room '{room_name}' not found"}, [], None
+
+    result = {}
+    for key in keys:
+        if room_name is None or key[0] == room_name:
+            result.setdefault(key[0], {"devices": {}})["devices"][key[1]] = device_at(data, key)
+    removed = [{"room": room, "device": device} for room, device in removed
+               if room_name is None or room == room_name]
+    return result, removed, version
+
+def search_devices(query=None, room=None, device_type=None, status=None, color=None, group=None,
+                   min_brightness=None, max_brightness=None):
+    """
+    Finds the devices matching every given criterion through the search
+    index (see DeviceIndex.search). The result is shaped like a LIST result
+    and, like get_device_status(), shares structure with a snapshot.
+    """
+    try:
+        min_brightness = int(min_brightness) if min_brightness is not None else None
+        max_brightness = int(max_brightness) if max_brightness is not None else None
+    except (TypeError, ValueError):
+        return {"error": "Brightness bounds must be whole numbers"}
+
+    data, keys = query_device_index(lambda index: index.search(query, room, device_type, status, color, group,
+                                                                min_brightness, max_brightness))
+    result = {}
+    for key in keys:
+        result.setdefault(key[0], {"devices": {}})["devices"][key[1]] = device_at(data, key)
+
+    if not result:
+        return {"error": "No devices match the search"}
+    return result
+
+def iter_devices(data, room_name=None, start_room=None):
+    """
+    Yields (room, device name, device) in home order, ending with the house
+    alarm. With start_room, the rooms before it are passed over without
+    visiting their devices.
+    """
+    rooms = data["home"]["rooms"]
+    names = [room_name] if room_name else rooms
+    if start_room is not None:
+        names = itertools.dropwhile(lambda name: name != start_room, names)
+    for name in names:
+        for device_name, device in rooms[name].get("devices", {}).items():
+            # The alarm lives in special_devices and is listed under "Home" below
+            if name == "Home" and device_name == "house_alarm":
+                continue
+            yield name, device_name, device
+    if room_name in (None, "Home"):
+        house_alarm = data["home"].get("special_devices", {}).get("house_alarm")
+        if house_alarm:
+            yield "Home", "house_alarm", house_alarm
+
+def get_device_page(cursor=0, page_size=50, room_name=None):
+    """
+    Get one page of devices, in home order, for one room or the whole home.
+    Returns (result, next_cursor); next_cursor is None after the last page.
+    Only the devices on the page are visited, never the whole home.
+    """
+    try:
+        cursor = int(cursor)
+        page_size = int(page_size)
+    except (TypeError, ValueError):
+        return {"error": "Invalid cursor or page size"}, None
+    if cursor < 0 or not 0 < page_size <= MAX_PAGE_SIZE:
+        return {"error": f"Page size must be between 1 and {MAX_PAGE_SIZE}"}, None
+
     data = load_data()
-    
+    rooms = data["home"]["rooms"]
+    if room_name and room_name not in rooms and room_name != "Home":
+        return {"error": f"Room '{room_name}' not found"}, None
+
+    # Skip whole rooms until the cursor falls inside one
+    skip = cursor
+    start_room = None
+    for name in ([room_name] if room_name else rooms):
+        if name not in rooms:
+            break
+        count = len(rooms[name].get("devices", {}))
+        if name == "Home" and "house_alarm" in rooms[name].get("devices", {}):
+            count -= 1
+        if skip < count:
+            start_room = name
+            break
+        skip -= count
+
+    if start_room is not None:
+        entries = iter_devices(data, room_name, start_room)
+    else:
+        # Past every room: only the house alarm can be left, skip places past it
+        house_alarm = data["home"].get("special_devices", {}).get("house_alarm")
+        entries = [("Home", "house_alarm", house_alarm)] if house_alarm and room_name in (None, "Home") else []
+
+    result = {}
+    next_cursor = None
+    for i, (name, device_name, device) in enumerate(itertools.islice(entries, skip, skip + page_size + 1)):
+        if i == page_size:
+            next_cursor = cursor + page_size
+            break
+        result.setdefault(name, {"devices": {}})["devices"][device_name] = device
+
+    return result, next_cursor
+
+def apply_house_alarm_change(draft, new_status, pin=None):
+    """Applies a house alarm change to a Draft without publishing it"""
+    data = draft.data
     try:
         if "special_devices" not in data["home"] or "house_alarm" not in data["home"]["special_devices"]:
             return {"error": "House alarm not found"}
@@ -177,22 +537,24 @@ def change_house_alarm_status(new_status, pin=None):
             return {"error": "Invalid PIN code for house alarm"}
         
         # Update alarm status
-        data["home"]["special_devices"]["house_alarm"]["status"] = new_status
-        data["home"]["special_devices"]["house_alarm"]["last_updated"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        # Save changes
-        save_data()
+        fields = {"status": new_status, "last_updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+        draft.update_device(None, "house_alarm", fields)
         
-        return {"success": f"House alarm status changed from {current_status} to {new_status}"}
+        return {"success": f"House alarm status changed from {current_status} to {new_status}",
+                "change": {"room": None, "device": "house_alarm", "fields": fields}}
         
     except Exception as e:
-        print(f"[ERROR] Unexpected error in change_house_alarm_status: {e}")
+        print(f"[ERROR] Unexpected error in apply_house_alarm_change: {e}")
         return {"error": f"An unexpected error occurred: {str(e)}"}
 
-def change_device_status(room_name, device_name, new_status, pin=None, brightness=None, color=None):
-    """Changes the status of a device in a room"""
-    data = load_data()
+def apply_device_change(draft, room_name, device_name, new_status, pin=None, brightness=None, color=None):
+    """
+    Applies a device change to a Draft without publishing it. A successful
+    result also carries the change record ({"room", "device", "fields"}).
+    """
+    data = draft.data
     changes_made = []
+    fields = {}
     
     try:
         if room_name not in data["home"]["rooms"] or device_name not in data["home"]["rooms"][room_name]["devices"]:
@@ -210,8 +572,25 @@ def change_device_status(room_name, device_name, new_status, pin=None, brightnes
         # Check for redundant changes
         current_status = device_info.get("status", "unknown")
         current_brightness = device_info.get("brightness")
+        
+        # The text codec delivers brightness as a string, the binary codec as an int
+        if brightness is not None:
+            try:
+                brightness = int(brightness)
+            except (TypeError, ValueError):
+                return {"error": f"Invalid brightness: '{brightness}'"}
+        if isinstance(current_brightness, str) and current_brightness.isdigit():
+            current_brightness = int(current_brightness)
         current_color = device_info.get("color", "white")
         
+        # Validate the color before anything is modified
+        valid_colors = [
+            "white", "red", "green", "blue", "yellow", "purple", 
+            "orange", "pink", "cyan", "magenta", "brown", "black"
+        ]
+        if color is not None and color.lower() not in valid_colors:
+            return {"error": f"Invalid color: '{color}'. Only standard color names are supported."}
+        
         if (new_status == current_status and 
             (brightness is None or brightness == current_brightness) and
             (color is None or color == current_color)):
@@ -220,58 +599,454 @@ def change_device_status(room_name, device_name, new_status, pin=None, brightnes
         # Update device status
         if new_status and new_status != current_status:
             old_status = current_status
-            data["home"]["rooms"][room_name]["devices"][device_name]["status"] = new_status
+            fields["status"] = new_status
             changes_made.append(f"status from {old_status} to {new_status}")
             
         # Update brightness if provided and different
         if brightness is not None and brightness != current_brightness:
             old_brightness = current_brightness if current_brightness is not None else 0
-            data["home"]["rooms"][room_name]["devices"][device_name]["brightness"] = brightness
+            fields["brightness"] = brightness
             changes_made.append(f"brightness from {old_brightness} to {brightness}")
             
-        # Validate and update color if provided and different
+        # Update color if provided and different
         if color is not None:
-            valid_colors = [
-                "white", "red", "green", "blue", "yellow", "purple", 
-                "orange", "pink", "cyan", "magenta", "brown", "black"
-            ]
-            if color.lower() not in valid_colors:
-                return {"error": f"Invalid color: '{color}'. Only standard color names are supported."}
-                
             if color.lower() != current_color.lower():
                 old_color = current_color
-                data["home"]["rooms"][room_name]["devices"][device_name]["color"] = color.lower()
+                fields["color"] = color.lower()
                 changes_made.append(f"color from {old_color} to {color.lower()}")
         
         # Update last_updated timestamp if any changes were made
         if changes_made:
-            data["home"]["rooms"][room_name]["devices"][device_name]["last_updated"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            
-            # Save changes
-            save_data()
+            fields["last_updated"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            draft.update_device(room_name, device_name, fields)
             
             print(f"[DEBUG] Successfully changed {device_name}: {', '.join(changes_made)}")
             
             # Create a detailed success message
             success_message = f"Device updated: {', '.join(changes_made)}"
-            return {"success": success_message}
+            return {"success": success_message,
+                    "change": {"room": room_name, "device": device_name, "fields": fields}}
         else:
             return {"info": "No changes needed - all values already match requested settings"}
         
     except Exception as e:
-        print(f"[ERROR] Unexpected error in change_device_status: {e}")
+        print(f"[ERROR] Unexpected error in apply_device_change: {e}")
         return {"error": f"An unexpected error occurred: {str(e)}"}
 
+def device_keys(data, targets):
+    """
+    Index keys of the (room, device) targets that exist in data, naming
+    the house alarm by its device name alone
+    """
+    keys = []
+    for room, device in targets:
+        if not isinstance(device, str) or not isinstance(room, (str, type(None))):
+            continue
+        key = HOUSE_ALARM if device == "house_alarm" else (room, device)
+        if DeviceIndex.lookup(data, key) is not None:
+            keys.append(key)
+    return keys
+
+def commit_changes(changes):
+    """
+    Publishes applied change records on top of the latest snapshot, then
+    persists them and notifies subscribers. The caller holds the write locks of every device the
+    records touch, so no other writer can have changed those devices since
+    the records were computed.
+    """
+    with data_lock:
+        version = state_version + 1
+        for change in changes:
+            # Stamp each changed device with the state version that changed it
+            change["fields"]["version"] = version
+        published = publish_changes(changes, version)
+        change_log.append((version, changes))
+    with persist_lock:
+        # Read under persist_lock, so a full save never writes an older snapshot than the last one
+        get_store().record(changes, cached_data)
+    # Still under the write locks, so each device's notifications go out in order
+    keys = [HOUSE_ALARM if change["room"] is None else (change["room"], change["device"]) for change in changes]
+    subscriptions.publish(keys, lambda key: device_at(published, key), version)
+
+def publish_changes(changes, version):
+    """
+    Publishes change records on top of cached_data as state version, and
+    moves the LIST cache versions and device index along with it. Used by
+    commits and by prefork workers replaying the owner's commits; caller
+    holds data_lock.
+    """
+    global cached_data, state_version
+    draft = Draft(cached_data)
+    for change in changes:
+        draft.update_device(change["room"], change["device"], change["fields"])
+    cached_data = draft.data
+    for change in changes:
+        room = change["room"] or "Home"
+        room_versions[room] = room_versions.get(room, 0) + 1
+    if device_index is not None and device_index.data is draft.base:
+        device_index.advance(cached_data, changes)
+    # Bumped only once the snapshot is published, so a reader that sees
+    # the new version also sees the new snapshot (see get_list_cache)
+    state_version = version
+    return cached_data
+
+@owned
+def change_house_alarm_status(new_status, pin=None):
+    """Changes the status of the house alarm"""
+    with write_locks.hold([HOUSE_ALARM]):
+        result = apply_house_alarm_change(Draft(load_data()), new_status, pin)
+        if "success" in result:
+            commit_changes([result.pop("change")])
+    return result
+
+@owned
+def change_device_status(room_name, device_name, new_status, pin=None, brightness=None, color=None):
+    """Changes the status of a device in a room"""
+    with write_locks.hold(device_keys(load_data(), [(room_name, device_name)])):
+        result = apply_device_change(Draft(load_data()), room_name, device_name, new_status, pin, brightness, color)
+        if "success" in result:
+            commit_changes([result.pop("change")])
+    return result
+
+@owned
+def change_devices_batch(changes, atomic=True):
+    """
+    Applies a list of device changes with a single commit and save.
+    Each change is a dict with room, device, status and optionally pin,
+    brightness and color; device "house_alarm" targets the house alarm.
+    The locks of every device in the batch are taken up front, in sorted
+    order. With atomic set, any failed item rolls every item in the batch
+    back, which just means nothing is committed.
+    Returns a summary plus a per-item "results" list.
+    """
+    targets = [(change.get("room"), change.get("device")) for change in changes if isinstance(change, dict)]
+    with write_locks.hold(device_keys(load_data(), targets)):
+        return apply_devices_batch(changes, atomic)
+
+def apply_devices_batch(changes, atomic):
+    """Body of change_devices_batch; the caller holds the write locks"""
+    draft = Draft(load_data())
+    results = []
+    records = []
+
+    for change in changes:
+        if not isinstance(change, dict):
+            results.append({"status": "Error", "message": "Malformed change"})
+            continue
+        room = change.get("room")
+        device = change.get("device")
+
+        if device == "house_alarm":
+            result = apply_house_alarm_change(draft, change.get("status"), change.get("pin"))
+        else:
+            result = apply_device_change(draft, room, device, change.get("status"), change.get("pin"),
+                                         change.get("brightness"), change.get("color"))
+
+        if "success" in result:
+            records.append(result["change"])
+            results.append({"room": room, "device": device, "status": "Success", "message": result["success"]})
+        elif "info" in result:
+            results.append({"room": room, "device": device, "status": "Info", "message": result["info"]})
+        else:
+            results.append({"room": room, "device": device, "status": "Error", "message": result["error"]})
+
+    failed = sum(1 for r in results if r["status"] == "Error")
+    applied = sum(1 for r in results if r["status"] == "Success")
+
+    if failed and atomic:
+        return {"error": f"Batch rolled back: {failed} of {len(results)} changes failed", "results": results}
+
+    if applied:
+        commit_changes(records)
+    summary = f"{applied} of {len(results)} changes applied"
+    if failed:
+        return {"error": summary, "results": results}
+    if applied:
+        return {"success": summary, "results": results}
+    return {"info": summary, "results": results}
+
+class ClientSession:
+    """Per-connection state shared by every server mode"""
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.logged_in = False
+        self.username = None
+        self.active = True
+        # Frame format of the last request; responses use the same one
+        self.frame_version = FRAME_LEGACY
+        # Message codec agreed at login
+        self.codec = CODEC_TEXT
+        # Creates the Subscriber that pushes notifications over this
+        # connection; set by the server mode serving it
+        self.make_subscriber = None
+
+def handle_request(session, message):
+    """Processes one request for a client session and returns the response"""
+    print(f"[DEBUG] Received message: {message.marshal()}")
+
+    response = CSmessage()
+    response.setType(message.getType())
+    # Echo the request ID so pipelining clients can match responses
+    if message.getValue("req_id") is not None:
+        response.setRequestId(message.getValue("req_id"))
+
+    if message.getType() == REQS.LGIN:
+        session.username = message.getValue("username")
+        password = message.getValue("password")
+
+        if session.logged_in:
+            response.addValue("status", "Already logged in")
+        elif authenticate_user(session.username, password):
+            session.logged_in = True
+            response.addValue("status", "Login successful")
+            # The binary codec is only offered to clients already using V1 frames
+            if message.getValue("codec") == CODEC_BINARY and session.frame_version == FRAME_V1:
+                session.codec = CODEC_BINARY
+            response.addValue("codec", session.codec)
+            print(f"[SERVER] User '{session.username}' logged in successfully")
+        else:
+            response.addValue("status", "Invalid credentials")
+            print(f"[SERVER] Login failed for user '{session.username}'")
+
+    elif message.getType() == REQS.LOUT:
+        if session.logged_in:
+            print(f"[SERVER] User '{session.username}' logged out")
+            subscriptions.remove(session)
+            session.logged_in = False
+            session.username = None
+            response.addValue("status", "Logged out successfully")
+        else:
+            response.addValue("status", "Not logged in")
+
+    elif message.getType() == REQS.LIST:
+        if not session.logged_in:
+            print("[SERVER] Unauthorized LIST attempt")
+            response.addValue("status", "Unauthorized")
+        else:
+            filter_type = message.getValue("filter_type") if "filter_type" in message._data else "room"
+            page_size = message.getValue("page_size")
+            since = message.getValue("since")
+            next_cursor = None
+            version = None
+            removed = None
+            
+            if since is not None and filter_type in ("room", "all"):
+                # Only what changed after the version the client last saw
+                room = message.getValue("room") if filter_type == "room" else None
+                print(f"[DEBUG] Processing LIST changes for room: {room} since version {since}")
+                device_status, removed, version = get_device_changes(since, None if room == "all" else room)
+                
+            elif page_size is not None and filter_type in ("room", "all"):
+                # Paginated listing of one room or of the whole home
+                room = message.getValue("room") if filter_type == "room" else None
+                cursor = message.getValue("cursor") or 0
+                print(f"[DEBUG] Processing LIST page for room: {room}, cursor={cursor}, page_size={page_size}")
+                device_status, next_cursor = get_device_page(cursor, page_size, None if room == "all" else room)
+                    
+            elif filter_type == "room":
+                room = message.getValue("room")
+                print(f"[DEBUG] Processing LIST request for room: {room}")
+                
+                # Handle "all" rooms properly
+                if room == "all":
+                    device_status, version = get_encoded_device_status(("all", None))
+                else:
+                    device_status, version = get_encoded_device_status(("room", room), room_name=room)
+                    
+            elif filter_type == "group":
+                group = message.getValue("group")
+                print(f"[DEBUG] Processing LIST request for group: {group}")
+                device_status, version = get_encoded_device_status(("group", group), group=group)
+                
+            elif filter_type == "device":
+                device = message.getValue("device")
+                print(f"[DEBUG] Processing LIST request for device: {device}")
+                device_status, version = get_encoded_device_status(("device", device), device_name=device)
+                
+            else:  # "all" or default
+                print(f"[DEBUG] Processing LIST request for all devices")
+                device_status, version = get_encoded_device_status(("all", None))
+                
+            # Check if there was an error
+            if isinstance(device_status, dict) and "error" in device_status:
+                response.addValue("status", "Error")
+                response.addValue("message", device_status["error"])
+            else:
+                response.addValue("devices", device_status)
+                response.addValue("status", "Success")
+                if next_cursor is not None:
+                    response.addValue("next_cursor", next_cursor)
+                if removed is not None:
+                    response.addValue("removed", removed)
+                if version is not None:
+                    response.addValue("version", version)
+
+    elif message.getType() == REQS.CHG_STATUS:
+        if not session.logged_in:
+            print("[SERVER] Unauthorized CHG_STATUS attempt")
+            response.addValue("status", "Unauthorized")
+        else:
+            device = message.getValue("device")
+            
+            # Special handling for house alarm
+            if device == "house_alarm":
+                new_status = message.getValue("status")
+                pin = message.getValue("pin") if "pin" in message._data else None
+                
+                print(f"[DEBUG] User '{session.username}' changing house alarm to {new_status}")
+                result = change_house_alarm_status(new_status, pin)
+                
+                if "success" in result:
+                    response.addValue("status", "Success")
+                    response.addValue("message", result["success"])
+                elif "info" in result:
+                    response.addValue("status", "Info")
+                    response.addValue("message", result["info"])
+                else:
+                    response.addValue("status", "Error")
+                    response.addValue("message", result["error"])
+            else:
+                # Existing logic for other devices
+                room = message.getValue("room")
+                new_status = message.getValue("status")
+                pin = message.getValue("pin") if "pin" in message._data else None
+                brightness = message.getValue("brightness") if "brightness" in message._data else None
+                color = message.getValue("color") if "color" in message._data else None
+
+                print(f"[DEBUG] User '{session.username}' changing {device} in {room} to {new_status}")
+                print(f"[DEBUG] Additional properties: brightness={brightness}, color={color}, pin={pin}")
+                
+                result = change_device_status(room, device, new_status, pin, brightness, color)
+
+                if "success" in result:
+                    response.addValue("status", "Success")
+                    response.addValue("message", result["success"])
+                elif "info" in result:
+                    response.addValue("status", "Info")
+                    response.addValue("message", result["info"])
+                else:
+                    response.addValue("status", "Error")
+                    response.addValue("message", result["error"])
+
+    elif message.getType() == REQS.BATCH:
+        if not session.logged_in:
+            print("[SERVER] Unauthorized BATCH attempt")
+            response.addValue("status", "Unauthorized")
+        else:
+            changes = message.getValue("changes")
+            atomic = str(message.getValue("atomic") if "atomic" in message._data else True).lower() not in ("0", "false", "no")
+
+            if not isinstance(changes, list) or not changes:
+                response.addValue("status", "Error")
+                response.addValue("message", "BATCH needs a non-empty list of changes")
+            else:
+                print(f"[DEBUG] User '{session.username}' applying {len(changes)} changes (atomic={atomic})")
+                result = change_devices_batch(changes, atomic)
+
+                if "success" in result:
+                    response.addValue("status", "Success")
+                    response.addValue("message", result["success"])
+                elif "info" in result:
+                    response.addValue("status", "Info")
+                    response.addValue("message", result["info"])
+                else:
+                    response.addValue("status", "Error")
+                    response.addValue("message", result["error"])
+                response.addValue("results", result.get("results", []))
+
+    elif message.getType() == REQS.SRCH:
+        if not session.logged_in:
+            print("[SERVER] Unauthorized SRCH attempt")
+            response.addValue("status", "Unauthorized")
+        else:
+            criteria = {k: message.getValue(k) for k in SEARCH_CRITERIA if message.getValue(k) is not None}
+            print(f"[DEBUG] Processing SRCH request: {criteria}")
+            result = search_devices(**criteria)
+
+            if "error" in result:
+                response.addValue("status", "Error")
+                response.addValue("message", result["error"])
+            else:
+                response.addValue("devices", result)
+                response.addValue("status", "Success")
+
+    elif message.getType() == REQS.SUBSCRIBE:
+        if not session.logged_in:
+            print("[SERVER] Unauthorized SUBSCRIBE attempt")
+            response.addValue("status", "Unauthorized")
+        else:
+            room = message.getValue("room")
+            group = message.getValue("group")
+            device = message.getValue("device")
+            print(f"[DEBUG] User '{session.username}' subscribing to room={room}, group={group}, device={device}")
+
+            if session.make_subscriber is None:
+                response.addValue("status", "Error")
+                response.addValue("message", "Notifications are not available on this connection")
+            elif room is not None and room != "Home" and room not in load_data()["home"]["rooms"]:
+                response.addValue("status", "Error")
+                response.addValue("message", f"Room '{room}' not found")
+            else:
+                sub_id = subscriptions.subscribe(session, session.make_subscriber, room, group, device)
+                # A prefork replica can trail the owner by a poll; catch it up first
+                refresh_data()
+                response.addValue("status", "Success")
+                response.addValue("sub_id", sub_id)
+                # Changes after this version will be notified; LIST since it to close any gap
+                response.addValue("version", state_version)
+
+    elif message.getType() == REQS.UNSUBSCRIBE:
+        sub_id = message.getValue("sub_id")
+        try:
+            dropped = subscriptions.unsubscribe(session, None if sub_id is None else int(sub_id))
+        except (TypeError, ValueError):
+            dropped = 0
+        if dropped:
+            response.addValue("status", "Success")
+            response.addValue("message", f"{dropped} subscription(s) removed")
+        else:
+            response.addValue("status", "Error")
+            response.addValue("message", "No such subscription")
+
+    elif message.getType() == REQS.EXIT:
+        print(f"[SERVER] User '{session.username}' requested to exit")
+        response.addValue("status", "Goodbye")
+        session.active = False
+
+    else:
+        print(f"[ERROR] Unknown request type: {message.getType()}")
+        response.addValue("status", "Unknown request type")
+
+    print(f"[DEBUG] Sending response: {response.marshal()}")
+    return response
+
+def pack_response(session, response):
+    """Frames a response for the session, reporting responses its framing cannot carry"""
+    try:
+        return CSpdu.pack(response, session.frame_version, session.codec)
+    except ValueError as e:
+        print(f"[ERROR] {e}")
+        error = CSmessage()
+        error.setType(response.getType())
+        error.addValue("status", "Error")
+        error.addValue("message", "Response too large for legacy framing, reconnect with binary frames")
+        return CSpdu.pack(error, session.frame_version, session.codec)
+
 def handle_client(conn, addr):
     """Handles client communication over TCP"""
     pdu = CSpdu(conn)
-    logged_in = False
-    username = None
+    session = ClientSession(addr)
+    # Notifications are sent from another thread; whole frames only
+    send_lock = threading.Lock()
+    session.make_subscriber = lambda: ThreadedSubscriber(session, conn, send_lock)
+
+    pending = []
 
     try:
         print(f"\n[SERVER] Connection from {addr}")
 
-        while True:
+        while session.active:
             print("[DEBUG] Waiting for message from client...")
             try:
                 message = pdu.receive_message()
@@ -282,161 +1057,125 @@ def handle_client(conn, addr):
                 print(f"[ERROR] Failed to receive message: {e}")
                 break
 
-            print(f"[DEBUG] Received message: {message.marshal()}")
+            session.frame_version = pdu.frame_version
+            pending.append(pack_response(session, handle_request(session, message)))
+            # Answer pipelined requests back to back, with one send per burst
+            if not pdu.has_buffered_frame():
+                with send_lock:
+                    conn.sendall(b"".join(pending))
+                pending.clear()
 
-            response = CSmessage()
-            response.setType(message.getType())
+        if pending:
+            with send_lock:
+                conn.sendall(b"".join(pending))
 
-            if message.getType() == REQS.LGIN:
-                username = message.getValue("username")
-                password = message.getValue("password")
+    except Exception as e:
+        print(f"[SERVER ERROR] {e}")
 
-                if logged_in:
-                    response.addValue("status", "Already logged in")
-                elif authenticate_user(username, password):
-                    logged_in = True
-                    response.addValue("status", "Login successful")
-                    print(f"[SERVER] User '{username}' logged in successfully")
-                else:
-                    response.addValue("status", "Invalid credentials")
-                    print(f"[SERVER] Login failed for user '{username}'")
-
-            elif message.getType() == REQS.LOUT:
-                if logged_in:
-                    print(f"[SERVER] User '{username}' logged out")
-                    logged_in = False
-                    username = None
-                    response.addValue("status", "Logged out successfully")
-                else:
-                    response.addValue("status", "Not logged in")
+    finally:
+        subscriptions.remove(session)
+        conn.close()
+        print(f"[SERVER] Connection closed with {addr}")
 
-            elif message.getType() == REQS.LIST:
-                if not logged_in:
-                    print("[SERVER] Unauthorized LIST attempt")
-                    response.addValue("status", "Unauthorized")
-                else:
-                    filter_type = message.getValue("filter_type") if "filter_type" in message._data else "room"
-                    
-                    if filter_type == "room":
-                        room = message.getValue("room")
-                        print(f"[DEBUG] Processing LIST request for room: {room}")
-                        
-                        # Handle "all" rooms properly
-                        if room == "all":
-                            device_status = get_device_status(None)
-                        else:
-                            device_status = get_device_status(room_name=room)
-                            
-                    elif filter_type == "group":
-                        group = message.getValue("group")
-                        print(f"[DEBUG] Processing LIST request for group: {group}")
-                        device_status = get_device_status(group=group)
-                        
-                    elif filter_type == "device":
-                        device = message.getValue("device")
-                        print(f"[DEBUG] Processing LIST request for device: {device}")
-                        device_status = get_device_status(device_name=device)
-                        
-                    else:  # "all" or default
-                        print(f"[DEBUG] Processing LIST request for all devices")
-                        device_status = get_device_status()
-                        
-                    # Check if there was an error
-                    if "error" in device_status:
-                        response.addValue("status", "Error")
-                        response.addValue("message", device_status["error"])
-                    else:
-                        response.addValue("devices", device_status)
-                        response.addValue("status", "Success")
-
-            elif message.getType() == REQS.CHG_STATUS:
-                if not logged_in:
-                    print("[SERVER] Unauthorized CHG_STATUS attempt")
-                    response.addValue("status", "Unauthorized")
-                else:
-                    device = message.getValue("device")
-                    
-                    # Special handling for house alarm
-                    if device == "house_alarm":
-                        new_status = message.getValue("status")
-                        pin = message.getValue("pin") if "pin" in message._data else None
-                        
-                        print(f"[DEBUG] User '{username}' changing house alarm to {new_status}")
-                        result = change_house_alarm_status(new_status, pin)
-                        
-                        if "success" in result:
-                            response.addValue("status", "Success")
-                            response.addValue("message", result["success"])
-                        elif "info" in result:
-                            response.addValue("status", "Info")
-                            response.addValue("message", result["info"])
-                        else:
-                            response.addValue("status", "Error")
-                            response.addValue("message", result["error"])
-                    else:
-                        # Existing logic for other devices
-                        room = message.getValue("room")
-                        new_status = message.getValue("status")
-                        pin = message.getValue("pin") if "pin" in message._data else None
-                        brightness = message.getValue("brightness") if "brightness" in message._data else None
-                        color = message.getValue("color") if "color" in message._data else None
-
-                        print(f"[DEBUG] User '{username}' changing {device} in {room} to {new_status}")
-                        print(f"[DEBUG] Additional properties: brightness={brightness}, color={color}, pin={pin}")
-                        
-                        result = change_device_status(room, device, new_status, pin, brightness, color)
-
-                        if "success" in result:
-                            response.addValue("status", "Success")
-                            response.addValue("message", result["success"])
-                        elif "info" in result:
-                            response.addValue("status", "Info")
-                            response.addValue("message", result["info"])
-                        else:
-                            response.addValue("status", "Error")
-                            response.addValue("message", result["error"])
-
-            elif message.getType() == REQS.SRCH:
-                if not logged_in:
-                    response.addValue("status", "Unauthorized")
-                else:
-                    response.addValue("status", "Feature not implemented yet")
+async def handle_client_async(reader, writer):
+    """Handles one client on the asyncio engine using the shared request handlers"""
+    addr = writer.get_extra_info("peername")
+    session = ClientSession(addr)
+    # Changes are committed on the loop thread, so notifications can be written directly
+    session.make_subscriber = lambda: StreamSubscriber(session, writer)
 
-            elif message.getType() == REQS.EXIT:
-                print(f"[SERVER] User '{username}' requested to exit")
-                response.addValue("status", "Goodbye")
-                pdu.send_message(response)
-                break
+    try:
+        print(f"\n[SERVER] Connection from {addr}")
 
-            else:
-                print(f"[ERROR] Unknown request type: {message.getType()}")
-                response.addValue("status", "Unknown request type")
+        while session.active:
+            try:
+                first = await reader.readexactly(1)
+                header = first + await reader.readexactly(CSpdu.header_size(first[0]) - 1)
+                session.frame_version, flags, size = CSpdu.parse_header(header)
+                message = CSpdu.unpack(await reader.readexactly(size), flags)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                print("[ERROR] Connection lost. Closing client session.")
+                break
+            except Exception as e:
+                print(f"[ERROR] Failed to receive message: {e}")
+                break
 
-            print(f"[DEBUG] Sending response: {response.marshal()}")  
-            pdu.send_message(response)
+            writer.write(pack_response(session, handle_request(session, message)))
+            await writer.drain()
 
     except Exception as e:
         print(f"[SERVER ERROR] {e}")
 
     finally:
-        conn.close()
+        subscriptions.remove(session)
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
         print(f"[SERVER] Connection closed with {addr}")
 
 
-def start_server():
+# Client sockets currently being served by the worker pool
+active_connections = set()
+connections_lock = threading.Lock()
+
+def serve_connection(conn, addr):
+    """Runs handle_client on a pool thread, tracking the socket for shutdown"""
+    with connections_lock:
+        active_connections.add(conn)
+    try:
+        handle_client(conn, addr)
+    finally:
+        with connections_lock:
+            active_connections.discard(conn)
+
+def close_active_connections():
+    """Unblocks pool threads still waiting on their clients"""
+    with connections_lock:
+        for conn in active_connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+def start_server(host=HOST, port=PORT, max_workers=MAX_WORKERS, reuse_port=False):
+    """
+    Accepts clients and serves them on a bounded pool of worker threads.
+    With max_workers <= 1 each client is served inline, one at a time.
+    """
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # Lets every prefork worker bind the same port; the kernel spreads connections
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    executor = None
     
     try:
-        server_socket.bind(("127.0.0.1", 5000))
-        server_socket.listen(5)
-        print("[SERVER] Running on 127.0.0.1:5000")
+        server_socket.bind((host, port))
+        server_socket.listen(128)
+        print(f"[SERVER] Running on {host}:{port}")
+        if state_owner is None:
+            start_storage()
+
+        if max_workers > 1:
+            executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="client")
+            # Stop accepting while every worker is busy so extra clients
+            # wait in the listen backlog instead of an unbounded queue
+            slots = threading.BoundedSemaphore(max_workers)
+            print(f"[SERVER] Serving clients on {max_workers} worker threads")
 
         while True:
             try:
+                if executor:
+                    slots.acquire()
                 conn, addr = server_socket.accept()
-                # This will block until this client is done
-                handle_client(conn, addr)
+                if executor:
+                    future = executor.submit(serve_connection, conn, addr)
+                    future.add_done_callback(lambda _: slots.release())
+                else:
+                    # This will block until this client is done
+                    handle_client(conn, addr)
             except KeyboardInterrupt:
                 print("\n[SERVER] Shutting down gracefully...")
                 break
@@ -445,10 +1184,366 @@ def start_server():
         print(f"[SERVER ERROR] {e}")
     finally:
         server_socket.close()
+        if executor:
+            close_active_connections()
+            executor.shutdown(wait=True, cancel_futures=True)
+        close_storage()
+        report_lock_stats()
+        print("[SERVER] Server shut down")
+        sys.exit(0)
+
+async def serve_async(host, port):
+    """Runs the asyncio engine until cancelled"""
+    server = await asyncio.start_server(handle_client_async, host, port, backlog=1024)
+    print(f"[SERVER] Running on {host}:{port} (asyncio)")
+    async with server:
+        await server.serve_forever()
+
+def start_async_server(host=HOST, port=PORT):
+    """
+    Serves every client from one event loop, so thousands of mostly idle
+    connections cost a coroutine each instead of a thread.
+    """
+    start_storage()
+    try:
+        asyncio.run(serve_async(host, port))
+    except KeyboardInterrupt:
+        print("\n[SERVER] Shutting down gracefully...")
+    except Exception as e:
+        print(f"[SERVER ERROR] {e}")
+    finally:
+        close_storage()
+        report_lock_stats()
+        print("[SERVER] Server shut down")
+        sys.exit(0)
+
+class ReactorConnection:
+    """Non-blocking client socket with its partial input and pending output"""
+
+    def __init__(self, sock, addr, wake):
+        self.sock = sock
+        self.session = ClientSession(addr)
+        self.session.make_subscriber = lambda: BufferSubscriber(self.session, self, wake)
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+
+    def handle_readable(self):
+        """Reads what the socket has and answers every complete frame. Returns False on EOF"""
+        data = self.sock.recv(65536)
+        if not data:
+            return False
+        self.inbuf += data
+        while self.session.active:
+            frame = CSpdu.take_frame(self.inbuf)
+            if frame is None:
+                break
+            self.session.frame_version, flags, body = frame
+            response = handle_request(self.session, CSpdu.unpack(body, flags))
+            self.outbuf += pack_response(self.session, response)
+        return True
+
+    def handle_writable(self):
+        """Sends as much pending output as the socket accepts"""
+        if self.outbuf:
+            sent = self.sock.send(self.outbuf)
+            del self.outbuf[:sent]
+
+    def finished(self):
+        """True once the client has exited and its last response is flushed"""
+        return not self.session.active and not self.outbuf
+
+def start_reactor_server(host=HOST, port=PORT):
+    """
+    Multiplexes every client on one thread with selectors. All state changes
+    happen on that thread, so data_lock is replaced with a no-op lock, and
+    write-behind flushes are driven from the loop instead of a thread.
+    """
+    global data_lock
+    data_lock = NullLock()
+
+    sel = selectors.DefaultSelector()
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+    # Connections given notifications while another connection was being served
+    woken = set()
+
+    def close_connection(conn):
+        subscriptions.remove(conn.session)
+        woken.discard(conn)
+        sel.unregister(conn.sock)
+        conn.sock.close()
+        print(f"[SERVER] Connection closed with {conn.session.addr}")
+
+    def flush(conn):
+        """Writes what conn has pending, then closes it or waits for the events it needs next"""
+        try:
+            # Write straight away; only wait for EVENT_WRITE if the socket is full
+            conn.handle_writable()
+        except (BlockingIOError, InterruptedError):
+            pass
+        except Exception as e:
+            print(f"[ERROR] Closing client session: {e}")
+            close_connection(conn)
+            return
+        if conn.finished():
+            close_connection(conn)
+        else:
+            wanted = selectors.EVENT_WRITE if conn.outbuf else 0
+            if conn.session.active:
+                wanted |= selectors.EVENT_READ
+            if wanted != sel.get_key(conn.sock).events:
+                sel.modify(conn.sock, wanted, conn)
+
+    try:
+        server_socket.bind((host, port))
+        server_socket.listen(1024)
+        server_socket.setblocking(False)
+        sel.register(server_socket, selectors.EVENT_READ)
+        print(f"[SERVER] Running on {host}:{port} (reactor)")
+
+        while True:
+            try:
+                events = sel.select(store.time_until_due() if store else None)
+            except KeyboardInterrupt:
+                print("\n[SERVER] Shutting down gracefully...")
+                break
+
+            for key, mask in events:
+                if key.fileobj is server_socket:
+                    try:
+                        sock, addr = server_socket.accept()
+                    except BlockingIOError:
+                        continue
+                    sock.setblocking(False)
+                    print(f"\n[SERVER] Connection from {addr}")
+                    sel.register(sock, selectors.EVENT_READ, ReactorConnection(sock, addr, woken.add))
+                    continue
+
+                conn = key.data
+                woken.discard(conn)
+                try:
+                    if mask & selectors.EVENT_READ and conn.session.active:
+                        if not conn.handle_readable():
+                            close_connection(conn)
+                            continue
+                except (BlockingIOError, InterruptedError):
+                    pass
+                except Exception as e:
+                    print(f"[ERROR] Closing client session: {e}")
+                    close_connection(conn)
+                    continue
+                flush(conn)
+
+            while woken:
+                flush(woken.pop())
+
+            if store:
+                store.flush_if_due()
+
+    except Exception as e:
+        print(f"[SERVER ERROR] {e}")
+    finally:
+        for key in list(sel.get_map().values()):
+            key.fileobj.close()
+        sel.close()
+        close_storage()
+        report_lock_stats()
+        print("[SERVER] Server shut down")
+        sys.exit(0)
+
+class StateOwner:
+    """Served by the prefork parent; the only process that writes cached_data"""
+
+    @synchronized
+    def changes_since(self, version):
+        """
+        (state version, change records committed after version), or
+        (state version, None) if the change log no longer reaches back to it
+        """
+        if version == state_version:
+            return state_version, []
+        if not change_log or change_log[0][0] > version + 1:
+            return state_version, None
+        return state_version, [change for stamp, changes in change_log if stamp > version for change in changes]
+
+    @synchronized
+    def snapshot(self):
+        # Snapshots are immutable, so the proxy can pickle this one after the lock is released
+        return state_version, load_data()
+
+    def change_device_status(self, *args, **kwargs):
+        return change_device_status(*args, **kwargs)
+
+    def change_house_alarm_status(self, *args, **kwargs):
+        return change_house_alarm_status(*args, **kwargs)
+
+    def change_devices_batch(self, *args, **kwargs):
+        return change_devices_batch(*args, **kwargs)
+
+_state_owner_instance = StateOwner()
+
+def get_state_owner():
+    return _state_owner_instance
+
+class StateManager(BaseManager):
+    pass
+
+StateManager.register("state", callable=get_state_owner)
+
+def follow_owner(interval=NOTIFY_POLL_INTERVAL):
+    """
+    Prefork worker thread: the owner commits every change, so the worker
+    polls it, refreshes its replica when the owner has moved on and
+    notifies local subscribers of the devices that changed in between.
+    Consecutive commits seen in one poll are notified version by version.
+    If the owner is gone the worker shuts down rather than serve a replica
+    that can no longer change.
+    """
+    seen = state_version
+    while True:
+        time.sleep(interval)
+        try:
+            refresh_data()
+        except (OSError, EOFError) as e:
+            print(f"[ERROR] Lost the state owner: {e}, shutting down worker {os.getpid()}")
+            # Interrupt accept() in the main thread, which then shuts down like on Ctrl+C
+            os.kill(os.getpid(), signal.SIGINT)
+            return
+        if state_version == seen:
+            continue
+        if not len(subscriptions):
+            seen = state_version
+            continue
+        data, (stamped, version) = query_device_index(
+            lambda index: ([(index.changed[key], key) for key in index.changed_since(seen)], state_version))
+        for stamp, group in itertools.groupby(stamped, key=lambda entry: entry[0]):
+            subscriptions.publish([key for _, key in group], lambda key: device_at(data, key), stamp)
+        seen = version
+
+def raise_on_sigterm():
+    """Makes SIGTERM shut the process down the way Ctrl+C does"""
+    def interrupt(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, interrupt)
+
+def run_prefork_worker(host, port, max_workers, owner_address, authkey):
+    """Entry point of a prefork worker process"""
+    global state_owner, store
+    # Workers never write; the owner persists every change
+    store = None
+    if owner_server is not None:
+        # Forked with the worker; left open, connections to a dead owner would
+        # still be accepted and hang, the worker's own at exit included
+        owner_server.listener.close()
+    manager = StateManager(address=owner_address, authkey=authkey)
+    manager.connect()
+    state_owner = manager.state()
+    load_data()
+    threading.Thread(target=follow_owner, name="owner-follower", daemon=True).start()
+    print(f"[SERVER] Worker {os.getpid()} ready")
+    start_server(host, port, max_workers, reuse_port=True)
+
+def start_prefork_server(host=HOST, port=PORT, processes=None, max_workers=MAX_WORKERS):
+    """
+    Forks worker processes that all accept on the same port with SO_REUSEPORT.
+    Reads are answered from each worker's replica of the device state, while
+    every change is applied by this parent process, which owns the state.
+    Workers refresh their replicas by polling the owner, and shut down if
+    it goes away; SIGTERM stops the parent and its workers like Ctrl+C.
+    """
+    if not hasattr(socket, "SO_REUSEPORT"):
+        print("[SERVER ERROR] SO_REUSEPORT is not supported on this platform")
+        sys.exit(1)
+
+    global owner_server
+    processes = processes or os.cpu_count() or 1
+    load_data()
+    # Otherwise a terminated owner leaves its workers accepting clients it can no longer serve
+    raise_on_sigterm()
+
+    authkey = os.urandom(16)
+    manager = StateManager(address=("127.0.0.1", 0), authkey=authkey)
+    owner = owner_server = manager.get_server()
+    threading.Thread(target=owner.serve_forever, daemon=True).start()
+    print(f"[SERVER] State owner listening on {owner.address}")
+
+    workers = []
+    try:
+        for _ in range(processes):
+            worker = multiprocessing.Process(
+                target=run_prefork_worker,
+                args=(host, port, max_workers, owner.address, authkey),
+                daemon=True,
+            )
+            worker.start()
+            workers.append(worker)
+        print(f"[SERVER] Running on {host}:{port} with {processes} worker processes")
+        start_storage()
+
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        print("\n[SERVER] Shutting down gracefully...")
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+        close_storage()
+        report_lock_stats()
         print("[SERVER] Server shut down")
         sys.exit(0)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Smart Home server")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--mode", choices=["threaded", "asyncio", "reactor", "prefork"], default="threaded",
+                        help="threaded: worker pool per connection, asyncio: single event loop, "
+                             "reactor: single-threaded selectors loop, "
+                             "prefork: worker processes sharing the port")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS,
+                        help="size of the client worker pool (1 serves clients one at a time)")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="number of prefork worker processes (defaults to the CPU count)")
+    parser.add_argument("--write-behind", type=float, default=0.5, metavar="SECONDS",
+                        help="save once changes have been quiet this long (0 saves on every change)")
+    parser.add_argument("--max-latency", type=float, default=2.0, metavar="SECONDS",
+                        help="longest a change may wait before it is saved in write-behind mode")
+    parser.add_argument("--journal", action="store_true",
+                        help="append each change to a journal instead of rewriting the whole file")
+    parser.add_argument("--compact-threshold", type=int, default=1024 * 1024, metavar="BYTES",
+                        help="journal size at which it is folded into a new snapshot")
+    parser.add_argument("--lock-granularity", choices=GRANULARITIES, default="device",
+                        help="lock the whole home, one room or one device while a change is applied")
+    parser.add_argument("--data-file", default=DATA_FILE, metavar="PATH",
+                        help="JSON file the home is kept in, or imported from with --database")
+    parser.add_argument("--database", metavar="PATH",
+                        help="keep the home in this SQLite database instead of the JSON file")
+    parser.add_argument("--export-json", metavar="PATH",
+                        help="write the database out as JSON to PATH and exit (needs --database)")
+    args = parser.parse_args()
+
+    DATA_FILE = args.data_file
+    configure_locks(args.lock_granularity)
+    configure_storage(args.write_behind > 0, args.write_behind, args.max_latency,
+                      args.journal, args.compact_threshold, args.database)
+    if args.export_json:
+        if not args.database:
+            parser.error("--export-json needs --database")
+        if not store.export(args.export_json):
+            print("[ERROR] Database is empty, nothing to export")
+            sys.exit(1)
+        print(f"[SERVER] Exported {args.database} to {args.export_json}")
+        sys.exit(0)
     # Create data file if it doesn't exist
     load_data()
-    start_server()
\ No newline at end of file
+    if args.mode == "asyncio":
+        start_async_server(args.host, args.port)
+    elif args.mode == "reactor":
+        start_reactor_server(args.host, args.port)
+    elif args.mode == "prefork":
+        start_prefork_server(args.host, args.port, args.processes, args.workers)
+    else:
+        start_server(args.host, args.port, args.workers)
@@ -0,0 +1,261 @@
+import sys
+import os
+import socket
+import select
+import itertools
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from messaging.csmessage import CSmessage, REQS, CODEC_BINARY
+from messaging.cspdu import SmartHomePDU as CSpdu, FRAME_V1
+
+HOST = "127.0.0.1"
+PORT = 5000
+# Connections a client keeps open at most; callers beyond this wait for one
+POOL_SIZE = 4
+
+_request_ids = itertools.count(1)
+
+class SmartHomeError(Exception):
+    """A request the server refused, or a connection that could not be logged in"""
+
+    def __init__(self, status, message=None):
+        super().__init__(f"{status}: {message}" if message else status)
+        self.status = status
+        self.message = message
+
+def build_message(msg_type, values):
+    """A msg_type request carrying values, leaving out those that are None"""
+    msg = CSmessage()
+    msg.setType(msg_type)
+    for key, value in values.items():
+        if value is not None:
+            msg.addValue(key, value)
+    return msg
+
+def login_message(username, password):
+    """
+    An LGIN request asking for the binary codec; the connection switches to
+    it once the server answers in it
+    """
+    return build_message(REQS.LGIN, {"username": username, "password": password, "codec": CODEC_BINARY})
+
+def check_response(response):
+    """Returns response, or raises SmartHomeError if the server refused the request"""
+    status = response.getValue("status")
+    if status not in ("Success", "Info"):
+        raise SmartHomeError(status, response.getValue("message"))
+    return response
+
+class SmartHomeClient:
+    """
+    Programmatic client for automation code. It keeps a pool of up to
+    pool_size logged-in connections that concurrent callers share: each
+    call borrows an idle connection, or opens and logs in a new one while
+    the pool has room, and returns it afterwards. Only the first calls pay
+    for a TCP handshake and LGIN, and pipeline() sends several requests
+    in one write.
+
+    Requests the server refuses raise SmartHomeError. A pooled connection
+    that turns out to be broken, say because the server restarted, is
+    dropped and the request goes out on another one, unless it had
+    already been written: then it may have been applied, and the error is
+    raised rather than risk applying a change twice.
+    """
+
+    def __init__(self, username: str, password: str, host: str = HOST, port: int = PORT,
+                 pool_size: int = POOL_SIZE, timeout: float = 10.0):
+        self.username = username
+        self.password = password
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._idle = []
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def login(self) -> None:
+        """Checks the credentials by opening the first pooled connection"""
+        with self._connection():
+            pass
+
+    def list_room(self, room: str) -> dict:
+        """Devices of one room, shaped like a LIST result"""
+        return self._list(filter_type="room", room=room)
+
+    def list_group(self, group: str) -> dict:
+        """Devices whose type or one of whose groups is group"""
+        return self._list(filter_type="group", group=group)
+
+    def list_device(self, device: str) -> dict:
+        """Every device called device, in whichever room it is"""
+        return self._list(filter_type="device", device=device)
+
+    def list_all(self) -> dict:
+        """Every device in the home, the house alarm under "Home" """
+        return self._list(filter_type="all", room="all")
+
+    def change_status(self, room: str, device: str, status: str, pin: Optional[str] = None,
+                      brightness: Optional[int] = None, color: Optional[str] = None) -> str:
+        """
+        Changes a device and returns the server's message, which says
+        whether it was changed or already in that state
+        """
+        return self._change(room=room, device=device, status=status, pin=pin, brightness=brightness, color=color)
+
+    def arm_alarm(self, pin: str) -> str:
+        return self._change(device="house_alarm", status="armed", pin=pin)
+
+    def disarm_alarm(self, pin: str) -> str:
+        return self._change(device="house_alarm", status="disarmed", pin=pin)
+
+    def close(self) -> None:
+        """Logs out and closes every idle connection; borrowed ones close when returned"""
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for pdu in idle:
+            self._discard(pdu, goodbye=True)
+
+    def request(self, msg_type: REQS, **values) -> CSmessage:
+        """Sends one request on a pooled connection and returns the response"""
+        msg = build_message(msg_type, values)
+        return self._on_connection(lambda pdu: pdu.send_message(msg), self._receive)
+
+    def pipeline(self, requests) -> list:
+        """
+        Sends several independent requests, given as (msg_type, values)
+        pairs, on one pooled connection with a single write, then reads
+        their responses. Responses are matched to requests by request ID
+        and returned in request order. Refused requests are returned like
+        any other response rather than raised.
+        """
+        messages = [build_message(msg_type, values) for msg_type, values in requests]
+        for msg in messages:
+            msg.setRequestId(next(_request_ids))
+        return self._on_connection(lambda pdu: pdu.send_messages(messages),
+                                   lambda pdu: self._receive_all(pdu, messages))
+
+    def _on_connection(self, send, receive):
+        """
+        Writes a request with send(pdu) on a pooled connection and returns
+        receive(pdu). Only a request that could not be written to a reused
+        connection is sent again.
+        """
+        while True:
+            reused = sent = False
+            try:
+                with self._connection() as (pdu, reused):
+                    send(pdu)
+                    sent = True
+                    return receive(pdu)
+            except SmartHomeError:
+                raise
+            except Exception:
+                # Each failed idle connection is dropped, so this ends on a fresh one at the latest
+                if sent or not reused:
+                    raise
+
+    def _list(self, **values):
+        return check_response(self.request(REQS.LIST, **values)).getValue("devices")
+
+    def _change(self, **values):
+        return check_response(self.request(REQS.CHG_STATUS, **values)).getValue("message")
+
+    @staticmethod
+    def _exchange(pdu, msg):
+        pdu.send_message(msg)
+        return SmartHomeClient._receive(pdu)
+
+    @staticmethod
+    def _receive(pdu):
+        while True:
+            response = pdu.receive_message()
+            # Pooled connections never subscribe, but a notification is never a response
+            if response.getType() != REQS.NOTIFY:
+                return response
+
+    @staticmethod
+    def _receive_all(pdu, messages):
+        responses = {}
+        while len(responses) < len(messages):
+            response = pdu.receive_message()
+            if response.getType() != REQS.NOTIFY:
+                responses[response.getRequestId()] = response
+        return [responses.get(msg.getRequestId()) for msg in messages]
+
+    @contextmanager
+    def _connection(self):
+        """Borrows a logged-in connection, returning it to the pool unless it failed"""
+        if self._closed:
+            raise SmartHomeError("Closed", "The client has been closed")
+        self._slots.acquire()
+        pdu = None
+        try:
+            pdu = self._pop_idle()
+            reused = pdu is not None
+            if pdu is None:
+                pdu = self._connect()
+            yield pdu, reused
+        except BaseException:
+            if pdu is not None:
+                self._discard(pdu)
+            raise
+        else:
+            with self._lock:
+                closed = self._closed
+                if not closed:
+                    self._idle.append(pdu)
+            if closed:
+                self._discard(pdu, goodbye=True)
+        finally:
+            self._slots.release()
+
+    def _pop_idle(self):
+        """Takes an idle connection the server has not closed, or returns None"""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                pdu = self._idle.pop()
+            readable, _, _ = select.select([pdu], [], [], 0)
+            if not readable:
+                return pdu
+            # Nothing is sent to an idle connection, so the server closed or reset it
+            self._discard(pdu)
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        pdu = CSpdu(sock, FRAME_V1)
+        try:
+            response = self._exchange(pdu, login_message(self.username, self.password))
+        except BaseException:
+            sock.close()
+            raise
+        if response.getValue("status") != "Login successful":
+            sock.close()
+            raise SmartHomeError(response.getValue("status"), f"Login failed for user '{self.username}'")
+        return pdu
+
+    @staticmethod
+    def _discard(pdu, goodbye=False):
+        try:
+            if goodbye:
+                msg = CSmessage()
+                msg.setType(REQS.EXIT)
+                SmartHomeClient._exchange(pdu, msg)
+        except Exception:
+            pass
+        finally:
+            pdu.close()
@@ -0,0 +1,243 @@
+import re
+import bisect
+
+HOUSE_ALARM = ("Home", "house_alarm")
+
+# Device attributes that are indexed, and so must be refiled when they change
+INDEXED_FIELDS = ("type", "groups", "status", "color", "brightness")
+
+_CAMEL = re.compile(r"([a-z0-9])([A-Z])")
+_WORDS = re.compile(r"[0-9a-z]+")
+_PARTS = re.compile(r"[a-z]+|[0-9]+")
+
+def tokenize(text):
+    """
+    Splits text into lower-case search tokens: whole words, and the letter
+    and digit runs inside them, so "WindowBlind" gives "windowblind",
+    "window" and "blind", and "bedroom_light1" gives "bedroom", "light1"
+    and "light".
+    """
+    text = str(text)
+    tokens = set(_WORDS.findall(text.lower()))
+    for word in _WORDS.findall(_CAMEL.sub(r"\1 \2", text).lower()):
+        tokens.add(word)
+        tokens.update(_PARTS.findall(word))
+    return tokens
+
+def _brightness(device):
+    try:
+        return int(device["brightness"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+class DeviceIndex:
+    """
+    Secondary and search indexes over a home document. Entries are
+    (room, device name) keys in home order; the device dicts themselves are
+    looked up in the document when a query runs, so the index stays valid
+    when a device dict is replaced by a copy. The house alarm is indexed under
+    ("Home", "house_alarm").
+
+    postings maps (field, value) terms to the keys they describe: exact
+    lower-cased "type", "status", "color" and "room" values, group names
+    as stored, and "token" terms from tokenize() for free-text search.
+    Numeric brightness is kept in a sorted list for range queries.
+
+    changed orders keys by the state version stamped on the device by its
+    last change, oldest first, so the devices changed after a version are
+    found by walking back from the end. Devices that disappear in a commit
+    leave a (version, key) tombstone in removed.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.postings = {}
+        self.by_name = {}
+        # Sorted token terms, for prefix lookups
+        self.vocabulary = []
+        # Sorted (brightness, position) pairs
+        self.brightness = []
+        # Home order of every key, and the key at each position
+        self._position = {}
+        self._keys = []
+        # Terms and brightness each key is filed under, so it can be unfiled again
+        self._filed = {}
+        self.changed = {}
+        self.removed = []
+        rooms = data["home"]["rooms"]
+        for room_name, room in rooms.items():
+            for device_name, device in room.get("devices", {}).items():
+                self._add((room_name, device_name), device)
+        house_alarm = data["home"].get("special_devices", {}).get("house_alarm")
+        if house_alarm:
+            self._add(HOUSE_ALARM, house_alarm)
+        stamped = [(int(self.device(key).get("version", 0)), self._position[key]) for key in self._keys]
+        for version, position in sorted(stamped):
+            if version:
+                self.changed[self._keys[position]] = version
+
+    @staticmethod
+    def lookup(data, key):
+        """Returns the device for key in data, or None if it does not exist"""
+        if key == HOUSE_ALARM:
+            house_alarm = data["home"].get("special_devices", {}).get("house_alarm")
+            if house_alarm:
+                return house_alarm
+        room = data["home"]["rooms"].get(key[0])
+        return room.get("devices", {}).get(key[1]) if room else None
+
+    def device(self, key):
+        """Returns the device for key, or None if it no longer exists"""
+        return self.lookup(self.data, key)
+
+    def group(self, group):
+        """Keys of devices whose type or one of whose groups is group, in home order"""
+        return self._ordered(self._group_keys(group))
+
+    def named(self, device_name):
+        """Keys of every device called device_name, in home order"""
+        return list(self.by_name.get(device_name, ()))
+
+    def search(self, query=None, room=None, device_type=None, status=None, color=None, group=None,
+               min_brightness=None, max_brightness=None):
+        """
+        Keys of the devices matching every given criterion, in home order.
+        Each word of query must be a prefix of one of the device's tokens;
+        the other criteria match exactly, ignoring case, and the brightness
+        bounds are inclusive.
+        """
+        candidates = []
+        for field, value in (("room", room), ("type", device_type), ("status", status), ("color", color)):
+            if value is not None:
+                candidates.append(self.postings.get((field, str(value).lower()), {}).keys())
+        if group is not None:
+            candidates.append(self._group_keys(group))
+        for word in _WORDS.findall(str(query or "").lower()):
+            candidates.append(self._prefix_keys(word))
+        ranged = min_brightness is not None or max_brightness is not None
+
+        if not candidates:
+            if ranged:
+                return self._ordered(self._brightness_keys(min_brightness, max_brightness))
+            return self._ordered(self._filed)
+        # Start from the most selective criterion and only probe the others
+        candidates.sort(key=len)
+        keys = candidates[0]
+        for other in candidates[1:]:
+            keys = [key for key in keys if key in other]
+        if ranged:
+            low = float("-inf") if min_brightness is None else min_brightness
+            high = float("inf") if max_brightness is None else max_brightness
+            keys = [key for key in keys
+                    if self._filed[key][1] is not None and low <= self._filed[key][1] <= high]
+        return self._ordered(keys)
+
+    def advance(self, data, changes):
+        """Moves the index to data, the document a commit of changes produced"""
+        self.data = data
+        self.update(changes)
+
+    def changed_since(self, version):
+        """Keys of devices last changed after version, in the order they changed"""
+        keys = []
+        for key in reversed(self.changed):
+            if self.changed[key] <= version:
+                break
+            keys.append(key)
+        keys.reverse()
+        return keys
+
+    def removed_since(self, version):
+        """Keys of devices removed after version"""
+        return [key for removed_at, key in self.removed if removed_at > version]
+
+    def update(self, changes):
+        """Refiles devices whose indexed attributes a commit changed and records the commit's version"""
+        for change in changes:
+            key = HOUSE_ALARM if change["room"] is None else (change["room"], change["device"])
+            device = self.device(key)
+            version = change["fields"].get("version")
+            if device is None:
+                if key in self._filed:
+                    self._unfile(key)
+                    self.changed.pop(key, None)
+                    self.removed.append((version or 0, key))
+                continue
+            if version is not None:
+                self.changed.pop(key, None)
+                self.changed[key] = version
+            if any(field in change["fields"] for field in INDEXED_FIELDS):
+                self._unfile(key)
+                self._file(key, device)
+
+    def _ordered(self, keys):
+        return sorted(keys, key=self._position.__getitem__)
+
+    def _group_keys(self, group):
+        group = group.lower()
+        return self.postings.get(("type", group), {}).keys() | self.postings.get(("group", group), {}).keys()
+
+    def _prefix_keys(self, prefix):
+        keys = set()
+        i = bisect.bisect_left(self.vocabulary, prefix)
+        while i < len(self.vocabulary) and self.vocabulary[i].startswith(prefix):
+            keys.update(self.postings[("token", self.vocabulary[i])])
+            i += 1
+        return keys
+
+    def _brightness_keys(self, low, high):
+        start = 0 if low is None else bisect.bisect_left(self.brightness, (low,))
+        end = len(self.brightness) if high is None else bisect.bisect_left(self.brightness, (high + 1,))
+        return {self._keys[position] for _, position in self.brightness[start:end]}
+
+    def _add(self, key, device):
+        if key in self._position:
+            # A stray copy of the alarm in a "Home" room; the special device wins
+            self._unfile(key)
+        else:
+            self._position[key] = len(self._keys)
+            self._keys.append(key)
+            self.by_name.setdefault(key[1], {})[key] = None
+        self._file(key, device)
+
+    def _terms(self, key, device):
+        room_name, device_name = key
+        terms = {("room", room_name.lower()), ("type", str(device.get("type", "")).lower())}
+        for field in ("status", "color"):
+            if device.get(field) is not None:
+                terms.add((field, str(device[field]).lower()))
+        # Group names are matched as stored, against the lower-cased query
+        groups = device.get("groups", ())
+        terms.update(("group", group) for group in groups)
+        tokens = tokenize(room_name) | tokenize(device_name)
+        for value in (device.get("type"), device.get("status"), device.get("color"), *groups):
+            if value is not None:
+                tokens |= tokenize(value)
+        terms.update(("token", token) for token in tokens)
+        return terms
+
+    def _file(self, key, device):
+        terms = self._terms(key, device)
+        for term in terms:
+            posting = self.postings.get(term)
+            if posting is None:
+                posting = self.postings[term] = {}
+                if term[0] == "token":
+                    bisect.insort(self.vocabulary, term[1])
+            posting[key] = None
+        brightness = _brightness(device)
+        if brightness is not None:
+            bisect.insort(self.brightness, (brightness, self._position[key]))
+        self._filed[key] = (terms, brightness)
+
+    def _unfile(self, key):
+        terms, brightness = self._filed.pop(key)
+        for term in terms:
+            posting = self.postings[term]
+            del posting[key]
+            if not posting:
+                del self.postings[term]
+                if term[0] == "token":
+                    del self.vocabulary[bisect.bisect_left(self.vocabulary, term[1])]
+        if brightness is not None:
+            del self.brightness[bisect.bisect_left(self.brightness, (brightness, self._position[key]))]
@@ -0,0 +1,229 @@
+import os
+import json
+import time
+import tempfile
+import threading
+from storage.store import Store
+
+class JSONStore(Store):
+    """
+    Persists the home as a single JSON document.
+
+    In write-behind mode save() only marks the state dirty. The document is
+    written once changes have been quiet for `interval` seconds, or at the
+    latest `max_latency` seconds after the first unsaved change, so a burst of
+    changes collapses into one write. Every write goes to a temporary file
+    that is atomically renamed over the document.
+
+    In journal mode each committed change is appended to `<path>.journal`
+    instead, and load() replays the journal over the last snapshot. Once the
+    journal grows past `compact_threshold` bytes it is folded into a new
+    snapshot in the background.
+    """
+
+    def __init__(self, path, write_behind=False, interval=0.5, max_latency=2.0,
+                 journal=False, compact_threshold=1024 * 1024):
+        self.path = path
+        self.write_behind = write_behind
+        self.interval = interval
+        self.max_latency = max_latency
+        self.journal = journal
+        self.compact_threshold = compact_threshold
+        self.journal_path = path + ".journal"
+        # Journal being folded into a snapshot; replayed too if a compaction was interrupted
+        self.compacting_path = path + ".journal.compacting"
+        self._journal_file = None
+        self._data = None
+        self._first_change = None
+        self._last_change = None
+        self._compact_requested = False
+        self._cond = threading.Condition()
+        self._thread = None
+        self._closed = False
+
+    def load(self):
+        try:
+            with open(self.path, "r") as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return None
+        if self.journal:
+            replayed = 0
+            for path in (self.compacting_path, self.journal_path):
+                replayed += self._replay(data, path)
+            if replayed:
+                print(f"[DEBUG] Replayed {replayed} journal records")
+        return data
+
+    def save(self, data):
+        """Writes data now, or schedules the write in write-behind mode"""
+        if not self.write_behind:
+            self._write(json.dumps(data, indent=4))
+            return
+        with self._cond:
+            now = time.monotonic()
+            self._data = data
+            if self._first_change is None:
+                self._first_change = now
+            self._last_change = now
+            self._cond.notify()
+
+    def record(self, changes, data):
+        """Appends changes to the journal, or saves data outside journal mode"""
+        if not self.journal:
+            self.save(data)
+            return
+        with self._cond:
+            if self._journal_file is None:
+                self._journal_file = self._open_journal()
+            # One line per commit, so a torn write can only lose the last commit
+            self._journal_file.write(json.dumps(changes, separators=(",", ":")) + "\n")
+            self._journal_file.flush()
+            self._data = data
+            if not self._compact_requested and self._journal_file.tell() > self.compact_threshold:
+                self._compact_requested = True
+                self._cond.notify()
+
+    def time_until_due(self):
+        with self._cond:
+            if self._compact_requested:
+                return 0.0
+            if self._first_change is None:
+                return None
+            now = time.monotonic()
+            return max(0.0, min(self._last_change + self.interval,
+                                self._first_change + self.max_latency) - now)
+
+    def flush(self, lock=None):
+        """
+        Writes pending changes, if any. lock must be the one record() and
+        save() are called under: the document to write is taken, and the
+        journal it covers moved aside, without a commit in between.
+        Documents are immutable snapshots, so they are serialized after
+        the lock is released.
+        """
+        with (lock if lock is not None else self._cond):
+            with self._cond:
+                data = self._data
+                compact = self._compact_requested
+                pending = self._first_change is not None
+                self._compact_requested = False
+                self._first_change = self._last_change = None
+                if not pending and not compact:
+                    return
+                self._data = None
+            if data is None:
+                return
+            if compact:
+                self._rotate_journal()
+        self._write(json.dumps(data, indent=4))
+        if compact and os.path.exists(self.compacting_path):
+            os.unlink(self.compacting_path)
+            print("[DEBUG] Journal compacted into snapshot")
+
+    def flush_if_due(self, lock=None):
+        """Flushes when the debounce interval or latency bound has passed"""
+        due = self.time_until_due()
+        if due is not None and due <= 0:
+            self.flush(lock)
+
+    def needs_thread(self):
+        return self.write_behind or self.journal
+
+    def start(self, lock):
+        """Flushes from a background thread until close()"""
+        self._thread = threading.Thread(target=self._run, args=(lock,), name="json-store", daemon=True)
+        self._thread.start()
+
+    def _run(self, lock):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    due = self.time_until_due()
+                    if due is not None and due <= 0:
+                        break
+                    self._cond.wait(due)
+                if self._closed:
+                    return
+            try:
+                self.flush(lock)
+            except OSError as e:
+                print(f"[ERROR] Failed to save JSON: {e}")
+
+    def close(self, lock=None):
+        """Stops the background thread and writes anything still pending"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join()
+        self.flush(lock)
+        with self._cond:
+            if self._journal_file is not None:
+                self._journal_file.close()
+                self._journal_file = None
+
+    def _open_journal(self):
+        """Opens the live journal for appending, ending any torn last line first"""
+        file = open(self.journal_path, "a+")
+        if file.tell():
+            file.seek(file.tell() - 1)
+            if file.read(1) != "\n":
+                file.write("\n")
+        return file
+
+    def _rotate_journal(self):
+        """Moves the live journal aside so new records start a fresh one"""
+        with self._cond:
+            if self._journal_file is not None:
+                self._journal_file.close()
+                self._journal_file = None
+            if os.path.exists(self.journal_path):
+                if os.path.exists(self.compacting_path):
+                    # A previous compaction never finished; keep both sets of records
+                    with open(self.compacting_path, "a") as dst, open(self.journal_path) as src:
+                        dst.write(src.read())
+                    os.unlink(self.journal_path)
+                else:
+                    os.replace(self.journal_path, self.compacting_path)
+
+    def _replay(self, data, path):
+        """Applies the records in one journal file to data"""
+        count = 0
+        try:
+            with open(path, "r") as file:
+                for line in file:
+                    try:
+                        changes = json.loads(line)
+                    except ValueError:
+                        # Torn write from a crash; only that commit is lost
+                        print(f"[ERROR] Skipping damaged journal record in {path}")
+                        continue
+                    try:
+                        targets = [data["home"]["special_devices"][change["device"]] if change["room"] is None
+                                   else data["home"]["rooms"][change["room"]]["devices"][change["device"]]
+                                   for change in changes]
+                    except (KeyError, TypeError):
+                        # Names a device the snapshot does not have; skip the whole commit
+                        print(f"[ERROR] Skipping journal record for an unknown device in {path}")
+                        continue
+                    for target, change in zip(targets, changes):
+                        target.update(change["fields"])
+                        count += 1
+        except FileNotFoundError:
+            pass
+        return count
+
+    def _write(self, text):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix=".smart_home.", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, "w") as file:
+                file.write(text)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        print("[DEBUG] JSON saved successfully")
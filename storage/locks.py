@@ -0,0 +1,123 @@
+import threading
+from time import perf_counter
+from storage.device_index import HOUSE_ALARM
+
+# Lock granularities for writers, coarsest first
+GRANULARITIES = ("home", "room", "device")
+
+class InstrumentedLock:
+    """
+    A lock that counts acquisitions, how many of them had to wait, and the
+    total time spent waiting for and holding it. With reentrant set it
+    behaves like an RLock and only the outermost acquisition is counted.
+    The counters are only updated by the thread holding the lock.
+    """
+
+    def __init__(self, name, reentrant=False):
+        self.name = name
+        self._lock = threading.RLock() if reentrant else threading.Lock()
+        self._depth = 0
+        self._acquired_at = 0.0
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_time = 0.0
+        self.hold_time = 0.0
+        self.max_hold = 0.0
+
+    def acquire(self):
+        if not self._lock.acquire(blocking=False):
+            start = perf_counter()
+            self._lock.acquire()
+            self.contended += 1
+            self.wait_time += perf_counter() - start
+        self._depth += 1
+        if self._depth == 1:
+            self.acquisitions += 1
+            self._acquired_at = perf_counter()
+        return True
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            held = perf_counter() - self._acquired_at
+            self.hold_time += held
+            if held > self.max_hold:
+                self.max_hold = held
+        self._lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+    def stats(self):
+        return {
+            "acquisitions": self.acquisitions,
+            "contended": self.contended,
+            "wait_ms": round(self.wait_time * 1000, 3),
+            "hold_ms": round(self.hold_time * 1000, 3),
+            "max_hold_ms": round(self.max_hold * 1000, 3),
+        }
+
+class WriteLocks:
+    """
+    Locks that writers hold while they validate and apply changes, at one
+    of three granularities: a single lock for the home, one per room, or
+    one per device. The house alarm always has a lock of its own below the
+    home level. Locks are made on first use for devices that exist, and a
+    writer needing several takes them in sorted order, so concurrent
+    batches cannot deadlock.
+    """
+
+    def __init__(self, granularity="device"):
+        if granularity not in GRANULARITIES:
+            raise ValueError(f"Unknown lock granularity: {granularity}")
+        self.granularity = granularity
+        self._locks = {}
+        self._table_lock = threading.Lock()
+
+    def _name(self, key):
+        if self.granularity == "home":
+            return "home"
+        if key == HOUSE_ALARM:
+            return "house_alarm"
+        if self.granularity == "room":
+            return f"room:{key[0]}"
+        return f"device:{key[0]}/{key[1]}"
+
+    def _get(self, name):
+        lock = self._locks.get(name)
+        if lock is None:
+            with self._table_lock:
+                lock = self._locks.setdefault(name, InstrumentedLock(name))
+        return lock
+
+    def hold(self, keys):
+        """
+        Returns a context manager holding the locks for (room, device) keys.
+        Only pass keys of devices that exist, so clients cannot grow the table.
+        """
+        return _Held([self._get(name) for name in sorted({self._name(key) for key in keys})])
+
+    def stats(self):
+        """Per-lock counters, most contended first"""
+        locks = sorted(self._locks.values(), key=lambda lock: (-lock.contended, -lock.wait_time, lock.name))
+        return {lock.name: lock.stats() for lock in locks}
+
+class _Held:
+    """Acquires locks in the given order and releases them in reverse"""
+
+    def __init__(self, locks):
+        self._locks = locks
+
+    def __enter__(self):
+        for lock in self._locks:
+            lock.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        for lock in reversed(self._locks):
+            lock.release()
+        return False
@@ -0,0 +1,38 @@
+class Draft:
+    """
+    Copy-on-write edit of a published home document. The published document
+    is never modified: the first change to a device copies the containers
+    on its path (home, rooms, the room and its devices) and the device
+    itself, and everything else stays shared with the original. Publishing
+    is just replacing the reference to the old document with draft.data;
+    discarding the draft discards its changes.
+    """
+
+    def __init__(self, data):
+        self.base = data
+        self.data = dict(data)
+        self.data["home"] = dict(data["home"])
+        # Containers already copied into this draft
+        self._copied = set()
+
+    def update_device(self, room_name, device_name, fields):
+        """Sets fields on a device; room_name None targets special_devices"""
+        home = self.data["home"]
+        if room_name is None:
+            if "special_devices" not in self._copied:
+                home["special_devices"] = dict(home["special_devices"])
+                self._copied.add("special_devices")
+            devices = home["special_devices"]
+        else:
+            if "rooms" not in self._copied:
+                home["rooms"] = dict(home["rooms"])
+                self._copied.add("rooms")
+            if ("room", room_name) not in self._copied:
+                room = home["rooms"][room_name] = dict(home["rooms"][room_name])
+                room["devices"] = dict(room["devices"])
+                self._copied.add(("room", room_name))
+            devices = home["rooms"][room_name]["devices"]
+        device = dict(devices[device_name])
+        device.update(fields)
+        devices[device_name] = device
+        return device
@@ -0,0 +1,210 @@
+import json
+import sqlite3
+import threading
+from storage.store import Store
+from storage.json_store import JSONStore
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS home (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    password TEXT NOT NULL,
+    attributes TEXT
+);
+CREATE TABLE IF NOT EXISTS rooms (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    room_id TEXT,
+    attributes TEXT
+);
+CREATE TABLE IF NOT EXISTS devices (
+    id INTEGER PRIMARY KEY,
+    room INTEGER REFERENCES rooms(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    type TEXT
+);
+CREATE TABLE IF NOT EXISTS device_attributes (
+    id INTEGER PRIMARY KEY,
+    device_id INTEGER NOT NULL REFERENCES devices(id) ON DELETE CASCADE,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    UNIQUE (device_id, key)
+);
+CREATE UNIQUE INDEX IF NOT EXISTS devices_room_name ON devices(room, name);
+CREATE INDEX IF NOT EXISTS devices_type ON devices(type);
+"""
+
+# Columns added after the first release, created in older databases on connect
+ADDED_COLUMNS = (("users", "attributes", "TEXT"), ("rooms", "attributes", "TEXT"))
+
+# Devices with no room (room NULL) are the home's special devices
+FIND_DEVICE = "SELECT id FROM devices WHERE room IS (SELECT id FROM rooms WHERE name = ?) AND name = ?"
+
+class SQLiteStore(Store):
+    """
+    Persists the home in an SQLite database with one row per user, room,
+    device and device attribute. Committed changes update only the attribute
+    rows they touch. Attribute values are stored as JSON so "50" and 50 read
+    back as they were written. Any other fields of a user or a room are
+    kept as one JSON object in its attributes column, the way the home
+    table keeps the home's own fields.
+
+    The first load() of an empty database imports json_path, if it exists,
+    and export() writes the database back out in the same JSON format.
+    """
+
+    def __init__(self, path, json_path=None):
+        self.path = path
+        self.json_path = json_path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            # Used from whichever worker thread holds the data lock
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("PRAGMA foreign_keys=ON")
+            self._conn.executescript(SCHEMA)
+            for table, column, column_type in ADDED_COLUMNS:
+                columns = [row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")]
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+        return self._conn
+
+    def load(self):
+        with self._lock:
+            conn = self._connect()
+            if conn.execute("SELECT 1 FROM users UNION ALL SELECT 1 FROM rooms LIMIT 1").fetchone() is None:
+                data = self._import()
+                if data is not None:
+                    self._write(conn, data)
+                return data
+            return self._read(conn)
+
+    def save(self, data):
+        with self._lock:
+            self._write(self._connect(), data)
+        print("[DEBUG] Database saved successfully")
+
+    def record(self, changes, data):
+        with self._lock:
+            conn = self._connect()
+            rows = []
+            types = []
+            for change in changes:
+                room, device = change["room"], change["device"]
+                found = conn.execute(FIND_DEVICE, (room, device)).fetchone()
+                if found is None:
+                    # The snapshot is already published; the rest of the commit is still stored
+                    print(f"[ERROR] Skipping change for unknown device '{device}' in room '{room}'")
+                    continue
+                for key, value in change["fields"].items():
+                    if key == "type":
+                        types.append((value, found[0]))
+                    else:
+                        rows.append((found[0], key, json.dumps(value)))
+            with conn:
+                conn.executemany(
+                    "INSERT INTO device_attributes (device_id, key, value) VALUES (?, ?, ?) "
+                    "ON CONFLICT (device_id, key) DO UPDATE SET value = excluded.value",
+                    rows,
+                )
+                conn.executemany("UPDATE devices SET type = ? WHERE id = ?", types)
+
+    def close(self, lock=None):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def export(self, path):
+        """Writes the database out as a JSON document at path"""
+        data = self.load()
+        if data is None:
+            return False
+        JSONStore(path).save(data)
+        return True
+
+    def _import(self):
+        if not self.json_path:
+            return None
+        data = JSONStore(self.json_path).load()
+        if data is not None:
+            print(f"[DEBUG] Importing {self.json_path} into {self.path}")
+        return data
+
+    def _read(self, conn):
+        data = {"users": {}, "home": {}}
+        for username, password, attributes in conn.execute(
+                "SELECT username, password, attributes FROM users ORDER BY rowid"):
+            user = data["users"][username] = {"password": password}
+            if attributes is not None:
+                user.update(json.loads(attributes))
+
+        home = data["home"]
+        for key, value in conn.execute("SELECT key, value FROM home ORDER BY rowid"):
+            home[key] = json.loads(value)
+        rooms = home["rooms"] = {}
+        room_names = {}
+        for row_id, name, room_id, attributes in conn.execute(
+                "SELECT id, name, room_id, attributes FROM rooms ORDER BY id"):
+            room = rooms[name] = {}
+            if room_id is not None:
+                room["room_id"] = room_id
+            if attributes is not None:
+                room.update(json.loads(attributes))
+            room["devices"] = {}
+            room_names[row_id] = name
+
+        devices = {}
+        for device_id, room, name, device_type in conn.execute(
+                "SELECT id, room, name, type FROM devices ORDER BY id"):
+            if room is None:
+                parent = home.setdefault("special_devices", {})
+            else:
+                parent = rooms[room_names[room]]["devices"]
+            device = parent[name] = {}
+            if device_type is not None:
+                device["type"] = device_type
+            devices[device_id] = device
+
+        for device_id, key, value in conn.execute(
+                "SELECT device_id, key, value FROM device_attributes ORDER BY id"):
+            devices[device_id][key] = json.loads(value)
+        return data
+
+    def _write(self, conn, data):
+        """Replaces the whole database with data"""
+        home = data.get("home", {})
+        with conn:
+            for table in ("device_attributes", "devices", "rooms", "users", "home"):
+                conn.execute(f"DELETE FROM {table}")
+            conn.executemany("INSERT INTO users (username, password, attributes) VALUES (?, ?, ?)",
+                             [(name, str(user.get("password", "")), self._attributes(user, ("password",)))
+                              for name, user in data.get("users", {}).items()])
+            conn.executemany("INSERT INTO home (key, value) VALUES (?, ?)",
+                             [(k, json.dumps(v)) for k, v in home.items() if k not in ("rooms", "special_devices")])
+            for room_name, room in home.get("rooms", {}).items():
+                row_id = conn.execute("INSERT INTO rooms (name, room_id, attributes) VALUES (?, ?, ?)",
+                                      (room_name, room.get("room_id"),
+                                       self._attributes(room, ("room_id", "devices")))).lastrowid
+                self._write_devices(conn, row_id, room.get("devices", {}))
+            self._write_devices(conn, None, home.get("special_devices", {}))
+
+    @staticmethod
+    def _attributes(entry, columns):
+        """The fields of entry without a column of their own, as JSON, or None if there are none"""
+        extra = {k: v for k, v in entry.items() if k not in columns}
+        return json.dumps(extra) if extra else None
+
+    def _write_devices(self, conn, room, devices):
+        for name, device in devices.items():
+            device_id = conn.execute("INSERT INTO devices (room, name, type) VALUES (?, ?, ?)",
+                                     (room, name, device.get("type"))).lastrowid
+            conn.executemany("INSERT INTO device_attributes (device_id, key, value) VALUES (?, ?, ?)",
+                             [(device_id, k, json.dumps(v)) for k, v in device.items() if k != "type"])
@@ -0,0 +1,40 @@
+class Store:
+    """
+    Interface between the server's in-memory home document and where it is
+    persisted. The server loads the document once, applies changes to it in
+    memory and hands the store either the whole document (save) or the
+    change records it just applied (record).
+    """
+
+    def load(self):
+        """Returns the stored document, or None if there is none yet"""
+        raise NotImplementedError
+
+    def save(self, data):
+        """Persists the whole document"""
+        raise NotImplementedError
+
+    def record(self, changes, data):
+        """
+        Persists committed change records, each {"room", "device", "fields"}
+        with room None for special devices. data is the document they were
+        applied to, for stores that can only write it whole.
+        """
+        self.save(data)
+
+    def time_until_due(self):
+        """Seconds until pending work should be flushed, or None if there is none"""
+        return None
+
+    def flush_if_due(self, lock=None):
+        """Writes pending work once it is due; called by single-threaded servers"""
+
+    def needs_thread(self):
+        """True if start() should run a background flusher"""
+        return False
+
+    def start(self, lock):
+        """Starts background work; lock is the one record() and save() are called under"""
+
+    def close(self, lock=None):
+        """Writes anything still pending and releases resources"""
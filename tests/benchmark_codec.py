@@ -0,0 +1,239 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import copy
+import json
+import time
+import socket
+import argparse
+import contextlib
+import tracemalloc
+from messaging.csmessage import CSmessage, REQS, CODEC_TEXT, CODEC_BINARY
+from messaging.cspdu import SmartHomePDU as CSpdu, FRAME_V1
+
+DATA_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "smart_home.json")
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_codec_baseline.json")
+
+CODECS = (CODEC_TEXT, CODEC_BINARY)
+OPERATIONS = ("marshal", "unmarshal", "send_message", "receive_message")
+
+def list_response(devices):
+    msg = CSmessage()
+    msg.setType(REQS.LIST)
+    msg.setRequestId(42)
+    msg.addValue("devices", devices)
+    msg.addValue("status", "Success")
+    msg.addValue("version", 1234)
+    return msg
+
+def build_payloads(data_file=DATA_FILE, large_rooms=20, devices_per_room=25):
+    """
+    Messages the server really exchanges, from a login to LIST responses
+    for one room, for the stored home, and for a home of
+    large_rooms * devices_per_room lights
+    """
+    with open(data_file) as f:
+        data = json.load(f)
+    rooms = data["home"]["rooms"]
+    home = {name: {"devices": room.get("devices", {})} for name, room in rooms.items()}
+    home["Home"] = {"devices": {"house_alarm": data["home"]["special_devices"]["house_alarm"]}}
+
+    large = copy.deepcopy(home)
+    for r in range(large_rooms):
+        large[f"Room{r}"] = {"devices": {
+            f"room{r}_light{d}": {"type": "Light", "status": "off", "brightness": 0, "color": "white",
+                                  "groups": ["lights", f"floor{r % 3}"], "last_updated": "2025-03-06 23:14:20",
+                                  "version": r * devices_per_room + d}
+            for d in range(devices_per_room)}}
+
+    lgin = CSmessage()
+    lgin.setType(REQS.LGIN)
+    lgin.addValue("username", "admin")
+    lgin.addValue("password", "1234")
+    lgin.addValue("codec", CODEC_BINARY)
+
+    chg_status = CSmessage()
+    chg_status.setType(REQS.CHG_STATUS)
+    chg_status.setRequestId(7)
+    chg_status.addValue("room", "Living Room")
+    chg_status.addValue("device", "living_room_light1")
+    chg_status.addValue("status", "dimmed")
+    chg_status.addValue("brightness", 75)
+    chg_status.addValue("color", "blue")
+
+    first_room = next(iter(home))
+    return {
+        "lgin": lgin,
+        "chg_status": chg_status,
+        "list_room": list_response({first_room: home[first_room]}),
+        "list_home": list_response(home),
+        "list_large": list_response(large),
+    }
+
+def encode(msg, codec):
+    return msg.marshal_binary() if codec == CODEC_BINARY else msg.marshal()
+
+def decode(payload, codec):
+    msg = CSmessage()
+    if codec == CODEC_BINARY:
+        msg.unmarshal_binary(payload)
+    else:
+        msg.unmarshal(payload)
+    return msg
+
+class PduPair:
+    """Two SmartHomePDUs on the ends of a socketpair, sending V1 frames"""
+
+    def __init__(self, codec):
+        left, right = socket.socketpair()
+        self.sender = CSpdu(left, FRAME_V1, codec)
+        self.receiver = CSpdu(right, FRAME_V1, codec)
+
+    def close(self):
+        self.sender.close()
+        self.receiver.close()
+
+def _nothing():
+    pass
+
+def make_case(operation, msg, codec, pair):
+    """
+    Returns (before, run, after): run() is the timed operation, before() and
+    after() do the other half of a socket exchange off the clock
+    """
+    if operation == "marshal":
+        return _nothing, (lambda: encode(msg, codec)), _nothing
+    if operation == "unmarshal":
+        payload = encode(msg, codec)
+        return _nothing, (lambda: decode(payload, codec)), _nothing
+    if operation == "send_message":
+        return _nothing, (lambda: pair.sender.send_message(msg)), pair.receiver.receive_message
+    return (lambda: pair.sender.send_message(msg)), pair.receiver.receive_message, _nothing
+
+def time_case(case, min_time, repeats):
+    """Best ops/sec over repeats, each timing operations for at least min_time seconds"""
+    before, run, after = case
+    best = 0.0
+    for _ in range(repeats):
+        count = 0
+        elapsed = 0.0
+        while elapsed < min_time:
+            before()
+            start = time.perf_counter()
+            run()
+            elapsed += time.perf_counter() - start
+            after()
+            count += 1
+        best = max(best, count / elapsed)
+    return best
+
+def measure_allocations(case, samples):
+    """Mean bytes tracemalloc sees allocated at the peak of one operation"""
+    before, run, after = case
+    total = 0
+    tracemalloc.start()
+    try:
+        for _ in range(samples):
+            before()
+            tracemalloc.reset_peak()
+            start = tracemalloc.get_traced_memory()[0]
+            run()
+            total += tracemalloc.get_traced_memory()[1] - start
+            after()
+    finally:
+        tracemalloc.stop()
+    return total / samples
+
+def run_benchmarks(args):
+    payloads = build_payloads()
+    results = {}
+    for name, msg in payloads.items():
+        if args.payload and name not in args.payload:
+            continue
+        for codec in CODECS:
+            pair = PduPair(codec)
+            try:
+                for operation in OPERATIONS:
+                    if args.operation and operation not in args.operation:
+                        continue
+                    case = make_case(operation, msg, codec, pair)
+                    # SmartHomePDU and CSmessage.unmarshal log every message; formatting
+                    # those lines is part of the measurement, printing them is not
+                    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                        ops = time_case(case, args.min_time, args.repeats)
+                        allocated = measure_allocations(case, args.samples)
+                    results[f"{operation}/{codec}/{name}"] = {
+                        "ops_per_sec": round(ops, 1),
+                        "alloc_bytes_per_op": round(allocated),
+                        "payload_bytes": len(encode(msg, codec)),
+                    }
+            finally:
+                pair.close()
+    return results
+
+def compare(results, baseline, tolerance):
+    """Cases slower, or allocating more, than baseline by more than tolerance"""
+    regressions = {}
+    for case, result in results.items():
+        base = baseline.get(case)
+        if base is None:
+            continue
+        problems = []
+        if result["ops_per_sec"] < base["ops_per_sec"] * (1 - tolerance):
+            problems.append(f"ops/sec {base['ops_per_sec']} -> {result['ops_per_sec']}")
+        if result["alloc_bytes_per_op"] > base["alloc_bytes_per_op"] * (1 + tolerance) + 64:
+            problems.append(f"alloc bytes {base['alloc_bytes_per_op']} -> {result['alloc_bytes_per_op']}")
+        if problems:
+            regressions[case] = problems
+    return regressions
+
+def print_report(results, baseline):
+    print(f"\n{'case':38}{'ops/sec':>12}{'vs base':>9}{'alloc B/op':>12}{'payload B':>11}")
+    for case, result in results.items():
+        base = baseline.get(case)
+        change = f"{(result['ops_per_sec'] / base['ops_per_sec'] - 1) * 100:+.1f}%" if base else "-"
+        print(f"{case:38}{result['ops_per_sec']:>12}{change:>9}{result['alloc_bytes_per_op']:>12}"
+              f"{result['payload_bytes']:>11}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for CSmessage and SmartHomePDU")
+    parser.add_argument("--payload", action="append", metavar="NAME",
+                        help="only run this payload (lgin, chg_status, list_room, list_home, list_large), repeatable")
+    parser.add_argument("--operation", action="append", choices=OPERATIONS, help="only run this operation, repeatable")
+    parser.add_argument("--min-time", type=float, default=0.3, metavar="SECONDS",
+                        help="shortest time each repeat of a case runs")
+    parser.add_argument("--repeats", type=int, default=3, help="repeats per case; the best one counts")
+    parser.add_argument("--samples", type=int, default=50, help="operations traced to measure allocations")
+    parser.add_argument("--baseline", default=BASELINE, metavar="PATH", help="stored results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="fraction a case may be slower or allocate more than its baseline")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the new baseline")
+    parser.add_argument("--output", metavar="PATH", help="write the results to PATH as JSON")
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = run_benchmarks(args)
+    print_report(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\n[BENCHMARK] Results written to {args.output}")
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({**baseline, **results}, f, indent=2)
+        print(f"[BENCHMARK] Baseline saved to {args.baseline}")
+    elif baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        for case, problems in regressions.items():
+            print(f"[REGRESSION] {case}: {', '.join(problems)}")
+        if regressions:
+            sys.exit(1)
+        print(f"\n[BENCHMARK] No regressions against {args.baseline}")
+    else:
+        print(f"\n[BENCHMARK] No baseline at {args.baseline}; run with --save-baseline to store one")
@@ -0,0 +1,338 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import time
+import shutil
+import signal
+import random
+import socket
+import argparse
+import contextlib
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from messaging.csmessage import CSmessage, REQS, CODEC_BINARY
+from messaging.cspdu import SmartHomePDU as CSpdu, FRAME_LEGACY, FRAME_V1
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "networking", "server.py")
+DATA_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "smart_home.json")
+
+HOST = "127.0.0.1"
+PORT = 5050
+USERNAME = "admin"
+PASSWORD = "1234"
+
+# Operations a simulated client can be given, and the REQS type each one is reported under
+OPERATIONS = {
+    "lgin": REQS.LGIN,
+    "list_room": REQS.LIST,
+    "list_group": REQS.LIST,
+    "list_device": REQS.LIST,
+    "list_all": REQS.LIST,
+    "chg_status": REQS.CHG_STATUS,
+}
+DEFAULT_MIX = "lgin=1,list_room=4,list_group=2,list_device=2,list_all=1,chg_status=4"
+
+def parse_mix(text):
+    """Parses "op=weight,..." into {op: weight}"""
+    mix = {}
+    for part in text.split(","):
+        op, _, weight = part.partition("=")
+        op = op.strip()
+        if op not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"Unknown operation '{op}', expected one of {', '.join(OPERATIONS)}")
+        mix[op] = float(weight or 1)
+    return mix
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+def summarize(latencies):
+    """Count, mean and tail latencies in milliseconds"""
+    ordered = sorted(latencies)
+    ms = lambda seconds: round(seconds * 1000, 3)
+    return {
+        "count": len(ordered),
+        "mean_ms": ms(sum(ordered) / len(ordered)),
+        "p50_ms": ms(percentile(ordered, 0.50)),
+        "p95_ms": ms(percentile(ordered, 0.95)),
+        "p99_ms": ms(percentile(ordered, 0.99)),
+        "max_ms": ms(ordered[-1]),
+    }
+
+def wait_for_port(host, port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+def start_server(args, workdir):
+    """
+    Starts networking/server.py with its home in a scratch SQLite database
+    imported from smart_home.json, or in a scratch copy of smart_home.json
+    with storage "json", so CHG_STATUS never touches the stored home
+    """
+    data_file = os.path.join(workdir, "benchmark.json")
+    shutil.copy(DATA_FILE, data_file)
+    command = [sys.executable, SERVER, "--host", args.host, "--port", str(args.port), "--mode", args.mode,
+               "--data-file", data_file]
+    if args.storage == "database":
+        command += ["--database", os.path.join(workdir, "benchmark.db")]
+    command += args.server_arg
+    log = open(os.path.join(workdir, "server.log"), "w")
+    # A session of its own, so prefork workers can be stopped along with the server
+    server = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, cwd=workdir, start_new_session=True)
+    if not wait_for_port(args.host, args.port, 15):
+        stop_server(server)
+        raise SystemExit(f"[ERROR] Server did not start:\n{open(log.name).read()[-2000:]}")
+    return server
+
+def stop_server(server):
+    """Interrupts the server like Ctrl+C would, killing it if it does not exit"""
+    try:
+        os.killpg(server.pid, signal.SIGINT)
+        server.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        os.killpg(server.pid, signal.SIGKILL)
+        server.wait()
+    except ProcessLookupError:
+        pass
+
+class SimulatedClient:
+    """One connection issuing a weighted random mix of requests and timing each response"""
+
+    def __init__(self, config, targets, seed):
+        self.config = config
+        self.targets = targets
+        self.random = random.Random(seed)
+        self.ops = list(config["mix"])
+        self.weights = [config["mix"][op] for op in self.ops]
+        self.latencies = {}
+        self.errors = {}
+
+    def connect(self):
+        sock = socket.create_connection((self.config["host"], self.config["port"]), timeout=30)
+        self.pdu = CSpdu(sock, FRAME_V1 if self.config["binary"] else FRAME_LEGACY)
+        # Not timed: the clock starts once every client is connected
+        self.pdu.send_message(self.login_message())
+        if self.pdu.receive_message().getValue("status") != "Login successful":
+            raise SystemExit("[ERROR] Benchmark client could not log in")
+
+    def login_message(self):
+        msg = CSmessage()
+        msg.setType(REQS.LGIN)
+        msg.addValue("username", USERNAME)
+        msg.addValue("password", PASSWORD)
+        if self.config["binary"]:
+            msg.addValue("codec", CODEC_BINARY)
+        return msg
+
+    def send(self, op, msg, ok=("Success", "Info", "Login successful")):
+        start = time.perf_counter()
+        self.pdu.send_message(msg)
+        response = self.pdu.receive_message()
+        self.latencies.setdefault(op, []).append(time.perf_counter() - start)
+        if response.getValue("status") not in ok:
+            self.errors[op] = self.errors.get(op, 0) + 1
+
+    def run(self, deadline, requests):
+        sent = 0
+        while (requests and sent < requests) or (not requests and time.monotonic() < deadline):
+            op = self.random.choices(self.ops, self.weights)[0]
+            getattr(self, op)()
+            sent += 1
+        msg = CSmessage()
+        msg.setType(REQS.EXIT)
+        self.pdu.send_message(msg)
+        self.pdu.close()
+
+    def lgin(self):
+        # Log out first, untimed, so the login is a real one
+        msg = CSmessage()
+        msg.setType(REQS.LOUT)
+        self.pdu.send_message(msg)
+        self.pdu.receive_message()
+        self.send("lgin", self.login_message())
+
+    def list(self, op, **values):
+        msg = CSmessage()
+        msg.setType(REQS.LIST)
+        for key, value in values.items():
+            msg.addValue(key, value)
+        self.send(op, msg)
+
+    def list_room(self):
+        self.list("list_room", filter_type="room", room=self.random.choice(self.targets["rooms"]))
+
+    def list_group(self):
+        self.list("list_group", filter_type="group", group=self.random.choice(self.targets["groups"]))
+
+    def list_device(self):
+        self.list("list_device", filter_type="device", device=self.random.choice(self.targets["devices"])[1])
+
+    def list_all(self):
+        self.list("list_all", filter_type="all", room="all")
+
+    def chg_status(self):
+        room, device = self.random.choice(self.targets["lights"])
+        msg = CSmessage()
+        msg.setType(REQS.CHG_STATUS)
+        msg.addValue("room", room)
+        msg.addValue("device", device)
+        msg.addValue("status", self.random.choice(("on", "off")))
+        self.send("chg_status", msg)
+
+def run_clients(config, targets, client_ids, start_at, results):
+    """Process body: runs a thread per simulated client and reports their timings"""
+    # SmartHomePDU logs every message; keep that out of the report
+    sys.stdout = open(os.devnull, "w")
+    clients = [SimulatedClient(config, targets, seed) for seed in client_ids]
+    for client in clients:
+        client.connect()
+    # Start together, after every client in every process has connected
+    time.sleep(max(0.0, start_at - time.time()))
+    deadline = time.monotonic() + config["duration"]
+    threads = [threading.Thread(target=client.run, args=(deadline, config["requests"])) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies, errors = {}, {}
+    for client in clients:
+        for op, values in client.latencies.items():
+            latencies.setdefault(op, []).extend(values)
+        for op, count in client.errors.items():
+            errors[op] = errors.get(op, 0) + count
+    results.put((latencies, errors))
+
+def discover_targets(host, port):
+    """Rooms, groups, devices and lights to aim requests at, from one LIST of the whole home"""
+    sock = socket.create_connection((host, port), timeout=30)
+    pdu = CSpdu(sock)
+    for msg_type, values in ((REQS.LGIN, {"username": USERNAME, "password": PASSWORD}),
+                             (REQS.LIST, {"filter_type": "all", "room": "all"})):
+        msg = CSmessage()
+        msg.setType(msg_type)
+        for key, value in values.items():
+            msg.addValue(key, value)
+        pdu.send_message(msg)
+        response = pdu.receive_message()
+    pdu.close()
+
+    targets = {"rooms": [], "groups": set(), "devices": [], "lights": []}
+    for room, room_info in response.getValue("devices").items():
+        if room != "Home":
+            targets["rooms"].append(room)
+        for device_name, device in room_info.get("devices", {}).items():
+            targets["devices"].append((room, device_name))
+            targets["groups"].add(device.get("type", ""))
+            targets["groups"].update(device.get("groups", []))
+            if device.get("type") == "Light" and room != "Home":
+                targets["lights"].append((room, device_name))
+    targets["groups"] = sorted(group for group in targets["groups"] if group)
+    return targets
+
+def run_benchmark(args):
+    config = {"host": args.host, "port": args.port, "mix": args.mix, "binary": args.binary,
+              "duration": args.duration, "requests": args.requests}
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        targets = discover_targets(args.host, args.port)
+    processes = max(1, min(args.processes or os.cpu_count() or 1, args.clients))
+
+    results = multiprocessing.Queue()
+    start_at = time.time() + 1.0 + args.clients * 0.005
+    workers = []
+    for i in range(processes):
+        client_ids = list(range(i, args.clients, processes))
+        worker = multiprocessing.Process(target=run_clients, args=(config, targets, client_ids, start_at, results))
+        worker.start()
+        workers.append(worker)
+    collected = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start_at
+
+    latencies, errors = {}, {}
+    for worker_latencies, worker_errors in collected:
+        for op, values in worker_latencies.items():
+            latencies.setdefault(op, []).extend(values)
+        for op, count in worker_errors.items():
+            errors[op] = errors.get(op, 0) + count
+    by_type = {}
+    for op, values in latencies.items():
+        by_type.setdefault(OPERATIONS[op].name, []).extend(values)
+    total = sum(len(values) for values in latencies.values())
+    return {
+        "config": {"mode": args.mode, "storage": args.storage, "clients": args.clients, "processes": processes, "mix": args.mix,
+                   "binary": args.binary, "duration_s": args.duration, "requests_per_client": args.requests,
+                   "server_args": args.server_arg},
+        "elapsed_s": round(elapsed, 3),
+        "total_requests": total,
+        "throughput_rps": round(total / elapsed, 1) if elapsed > 0 else None,
+        "errors": errors,
+        "by_operation": {op: summarize(values) for op, values in sorted(latencies.items())},
+        "by_type": {name: summarize(values) for name, values in sorted(by_type.items())},
+    }
+
+def print_report(report):
+    print(f"\n[BENCHMARK] {report['config']['clients']} clients, mode {report['config']['mode']}: "
+          f"{report['total_requests']} requests in {report['elapsed_s']} s, {report['throughput_rps']} req/s")
+    if report["errors"]:
+        print(f"[BENCHMARK] Errors: {report['errors']}")
+    print(f"{'':14}{'count':>9}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}   (ms)")
+    for section in ("by_type", "by_operation"):
+        for name, stats in report[section].items():
+            print(f"{name:14}{stats['count']:>9}{stats['mean_ms']:>10}{stats['p50_ms']:>10}"
+                  f"{stats['p95_ms']:>10}{stats['p99_ms']:>10}{stats['max_ms']:>10}")
+        print()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load generator and latency benchmark for the Smart Home server")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--mode", choices=["threaded", "asyncio", "reactor", "prefork"], default="threaded",
+                        help="server mode to start")
+    parser.add_argument("--storage", choices=["database", "json"], default="database",
+                        help="keep the server's home in a scratch SQLite database or a scratch JSON file; "
+                             "JSON storage options go through --server-arg (e.g. --server-arg=--journal)")
+    parser.add_argument("--clients", type=int, default=16, help="simulated clients, one connection each")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="load generator processes the clients are spread over (defaults to the CPU count)")
+    parser.add_argument("--duration", type=float, default=10.0, metavar="SECONDS", help="how long each client runs")
+    parser.add_argument("--requests", type=int, default=0,
+                        help="requests per client instead of running for --duration")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"operation weights (default {DEFAULT_MIX})")
+    parser.add_argument("--binary", action="store_true", help="use V1 frames and the binary codec")
+    parser.add_argument("--no-server", action="store_true",
+                        help="benchmark a server already running on --host/--port instead of starting one")
+    parser.add_argument("--server-arg", action="append", default=[], metavar="ARG",
+                        help="extra argument for networking/server.py, repeatable (e.g. --server-arg=--workers=64)")
+    parser.add_argument("--output", metavar="PATH", help="write the results to PATH as JSON")
+    args = parser.parse_args()
+
+    server = None
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            if not args.no_server:
+                server = start_server(args, workdir)
+            report = run_benchmark(args)
+        finally:
+            if server is not None:
+                stop_server(server)
+
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"[BENCHMARK] Results written to {args.output}")
@@ -0,0 +1,96 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from messaging.csmessage import CSmessage, REQS, EncodedValue, KEY_LITERAL, INT_MAX
+
+DEVICES = {
+    "Kitchen": {"devices": {"kitchen_light1": {"status": "on", "brightness": 75, "dimmable": True,
+                                               "color": None, "groups": ["lights", ["nested", {"a": 1}]]}}},
+    "Home": {"devices": {}},
+}
+
+def message(msg_type, **values):
+    msg = CSmessage()
+    msg.setType(msg_type)
+    for key, value in values.items():
+        msg.addValue(key, value)
+    return msg
+
+def text_round_trip(msg):
+    received = CSmessage()
+    received.unmarshal(msg.marshal())
+    return received
+
+def binary_round_trip(msg):
+    received = CSmessage()
+    received.unmarshal_binary(msg.marshal_binary())
+    return received
+
+def test_separators_in_values_and_keys_survive():
+    msg = message(REQS.CHG_STATUS, room="a&b=c%26d", device="100%", color="=&=", **{"odd&key=": "x"})
+    for received in (text_round_trip(msg), binary_round_trip(msg)):
+        assert received._data == msg._data
+
+def test_nested_values_round_trip_in_both_codecs():
+    msg = message(REQS.LIST, devices=DEVICES, removed=[["Kitchen", "kitchen_light2"]], status="Success")
+    for received in (text_round_trip(msg), binary_round_trip(msg)):
+        assert received.getValue("devices") == DEVICES
+        assert received.getValue("removed") == [["Kitchen", "kitchen_light2"]]
+    # A value encoded once for many responses reads back like the value itself
+    cached = message(REQS.LIST, devices=EncodedValue(DEVICES))
+    assert text_round_trip(cached).getValue("devices") == DEVICES
+    assert binary_round_trip(cached).getValue("devices") == DEVICES
+
+def test_scalars():
+    msg = message(REQS.CHG_STATUS, brightness=75, version=-3, big=INT_MAX + 1, atomic=True, color=None)
+    # The text codec is untyped: scalars arrive in their str() form
+    assert text_round_trip(msg)._data == {"type": REQS.CHG_STATUS, "brightness": "75", "version": "-3",
+                                          "big": str(INT_MAX + 1), "atomic": "True", "color": "None"}
+    # The binary codec keeps 64-bit ints and sends anything wider as a string
+    assert binary_round_trip(msg)._data == {"type": REQS.CHG_STATUS, "brightness": 75, "version": -3,
+                                            "big": str(INT_MAX + 1), "atomic": "True", "color": "None"}
+
+def test_unknown_keys_round_trip():
+    msg = message(REQS.LIST, not_a_known_key="value", another=7)
+    assert text_round_trip(msg)._data == {"type": REQS.LIST, "not_a_known_key": "value", "another": "7"}
+    assert binary_round_trip(msg)._data == {"type": REQS.LIST, "not_a_known_key": "value", "another": 7}
+
+def test_json_only_decoded_for_structured_keys():
+    received = CSmessage()
+    received.unmarshal("type=LIST&room=[1]&devices={}&_json=room,devices")
+    assert received.getValue("room") == "[1]"
+    assert received.getValue("devices") == {}
+
+    msg = message(REQS.LIST, room=["Kitchen"])
+    assert binary_round_trip(msg).getValue("room") == '["Kitchen"]'
+
+def test_malformed_text_pairs_are_skipped():
+    received = CSmessage()
+    received.unmarshal("type=LIST&garbage&room=Kitchen&devices={&_json=devices")
+    assert received.getType() == REQS.LIST
+    assert received.getValue("room") == "Kitchen"
+    # Undecodable JSON stays as received
+    assert received.getValue("devices") == "{"
+
+def test_malformed_binary_frames_are_rejected():
+    body = message(REQS.LIST, room="Kitchen").marshal_binary()
+    for bad in (body[:2] + b"\x00" + body[3:],          # key code 0
+                body[:2] + b"\x7f" + body[3:],          # past the end of BINARY_KEYS
+                body[:3] + b"\x09" + body[4:]):         # unknown value tag
+        try:
+            CSmessage().unmarshal_binary(bad)
+        except ValueError:
+            continue
+        raise AssertionError(f"accepted {bad!r}")
+    # A literal key escapes the table
+    literal = body[:2] + bytes([KEY_LITERAL, 4]) + b"room" + body[3:]
+    received = CSmessage()
+    received.unmarshal_binary(literal)
+    assert received.getValue("room") == "Kitchen"
+
+if __name__ == "__main__":
+    tests = [value for name, value in list(globals().items()) if name.startswith("test_")]
+    for test in tests:
+        test()
+        print(f"[TEST] {test.__name__} passed")
@@ -0,0 +1,81 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+from storage.device_index import DeviceIndex, HOUSE_ALARM
+from storage.snapshot import Draft
+from networking.list_cache import ListCache
+
+DATA_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "smart_home.json")
+
+QUERIES = [
+    lambda index: index.group("Light"),
+    lambda index: index.group("windowblind"),
+    lambda index: index.named("kitchen_light1"),
+    lambda index: index.search(status="on"),
+    lambda index: index.search(color="blue"),
+    lambda index: index.search(query="bed light"),
+    lambda index: index.search(min_brightness=40, max_brightness=80),
+    lambda index: index.search(room="Kitchen", device_type="light"),
+]
+
+def load_home():
+    with open(DATA_FILE) as f:
+        return json.load(f)
+
+def advance(index, version, *changes):
+    """Commits (room, device, fields) changes at version and moves index to the result"""
+    draft = Draft(index.data)
+    records = []
+    for room, device, fields in changes:
+        fields = dict(fields, version=version)
+        draft.update_device(room, device, fields)
+        records.append({"room": room, "device": device, "fields": fields})
+    index.advance(draft.data, records)
+
+def test_advanced_index_matches_a_rebuilt_one():
+    index = DeviceIndex(load_home())
+    advance(index, 1, ("Kitchen", "kitchen_light1", {"status": "on", "brightness": 75, "color": "blue"}))
+    advance(index, 2, ("Bedroom", "bedroom_light1", {"status": "on", "brightness": 40}),
+            ("Living Room", "living_room_blind1", {"status": "closed"}))
+    advance(index, 3, ("Kitchen", "kitchen_light1", {"status": "off", "color": "red"}),
+            (None, "house_alarm", {"status": "armed"}))
+    rebuilt = DeviceIndex(index.data)
+    for query in QUERIES:
+        assert query(index) == query(rebuilt)
+
+def test_changed_since_lists_devices_in_change_order():
+    index = DeviceIndex(load_home())
+    assert index.changed_since(0) == []
+    advance(index, 1, ("Kitchen", "kitchen_light1", {"status": "on"}))
+    advance(index, 2, (None, "house_alarm", {"status": "armed"}))
+    advance(index, 3, ("Bedroom", "bedroom_light1", {"status": "on"}))
+    advance(index, 4, ("Kitchen", "kitchen_light1", {"status": "off"}))
+    assert index.changed_since(0) == [HOUSE_ALARM, ("Bedroom", "bedroom_light1"), ("Kitchen", "kitchen_light1")]
+    assert index.changed_since(2) == [("Bedroom", "bedroom_light1"), ("Kitchen", "kitchen_light1")]
+    assert index.changed_since(4) == []
+    # Stamps stored with the devices survive a rebuild, as after a restart
+    assert DeviceIndex(index.data).changed_since(1) == index.changed_since(1)
+
+def test_list_cache_serves_only_current_versions():
+    cache = ListCache(max_entries=2)
+    room_versions = {"Kitchen": 3}
+    assert ListCache.version_of(("room", "Kitchen"), 10, room_versions) == 3
+    assert ListCache.version_of(("room", "Bedroom"), 10, room_versions) == 0
+    assert ListCache.version_of(("all", None), 10, room_versions) == 10
+
+    cache.put(("all", None), 10, "home at 10")
+    assert cache.get(("all", None), 10) == "home at 10"
+    assert cache.get(("all", None), 11) is None
+    cache.put(("room", "Kitchen"), 3, "kitchen at 3")
+    cache.put(("group", "Light"), 10, "lights at 10")
+    # Least recently used entry dropped
+    assert cache.get(("all", None), 10) is None
+    assert cache.get(("room", "Kitchen"), 3) == "kitchen at 3"
+
+if __name__ == "__main__":
+    tests = [value for name, value in list(globals().items()) if name.startswith("test_")]
+    for test in tests:
+        test()
+        print(f"[TEST] {test.__name__} passed")
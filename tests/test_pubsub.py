@@ -0,0 +1,104 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from networking.pubsub import Subscriber, SubscriptionHub, NOTIFY_BUFFER_LIMIT
+
+DEVICES = {
+    ("Kitchen", "kitchen_light1"): {"type": "Light", "status": "on", "groups": ["downstairs"]},
+    ("Bedroom", "bedroom_light1"): {"type": "Light", "status": "off"},
+    ("Bedroom", "bedroom_lock1"): {"type": "Lock", "status": "locked"},
+    ("Home", "house_alarm"): {"type": "Alarm", "status": "armed"},
+}
+
+class RecordingSubscriber(Subscriber):
+    """Keeps the messages it is sent; backlog stands in for unsent bytes"""
+
+    def __init__(self, session):
+        super().__init__(session)
+        self.sent = []
+        self.backlog = 0
+
+    def pack(self, message):
+        return message
+
+    def pending(self):
+        return self.backlog
+
+    def send(self, frame):
+        self.sent.append(frame)
+
+    def notified(self):
+        """(status, version, sorted device keys) of each message sent"""
+        return [(message.getValue("status"), message.getValue("version"),
+                 sorted((room, name) for room, entry in (message.getValue("devices") or {}).items()
+                        for name in entry["devices"]))
+                for message in self.sent]
+
+def subscribe(hub, session, **filters):
+    subscribers = {}
+    hub.subscribe(session, lambda: subscribers.setdefault(session, RecordingSubscriber(session)), **filters)
+    return hub._subscribers[session]
+
+def publish(hub, version, *keys):
+    hub.publish(list(keys), DEVICES.get, version)
+
+def test_publish_fans_out_to_matching_filters():
+    hub = SubscriptionHub()
+    everything = subscribe(hub, "everything")
+    kitchen = subscribe(hub, "kitchen", room="Kitchen")
+    lights = subscribe(hub, "lights", group="light")
+    lock = subscribe(hub, "lock", device="bedroom_lock1")
+    downstairs = subscribe(hub, "downstairs", group="downstairs")
+    # A second filter on the same session widens it, and still sends one message per commit
+    subscribe(hub, "lock", device="house_alarm")
+    assert len(hub) == 5
+
+    publish(hub, 7, ("Kitchen", "kitchen_light1"), ("Bedroom", "bedroom_lock1"), ("Home", "house_alarm"))
+    publish(hub, 8, ("Bedroom", "bedroom_light1"), ("Garage", "gone"))
+
+    assert everything.notified() == [
+        ("Update", 7, [("Bedroom", "bedroom_lock1"), ("Home", "house_alarm"), ("Kitchen", "kitchen_light1")]),
+        ("Update", 8, [("Bedroom", "bedroom_light1")])]
+    assert kitchen.notified() == [("Update", 7, [("Kitchen", "kitchen_light1")])]
+    assert lights.notified() == [("Update", 7, [("Kitchen", "kitchen_light1")]),
+                                 ("Update", 8, [("Bedroom", "bedroom_light1")])]
+    assert lock.notified() == [("Update", 7, [("Bedroom", "bedroom_lock1"), ("Home", "house_alarm")])]
+    assert downstairs.notified() == [("Update", 7, [("Kitchen", "kitchen_light1")])]
+
+def test_unsubscribe_stops_notifications():
+    hub = SubscriptionHub()
+    kitchen = subscribe(hub, "kitchen", room="Kitchen")
+    subscribe(hub, "kitchen", room="Bedroom")
+    assert hub.unsubscribe("kitchen", 1) == 1
+    publish(hub, 1, ("Kitchen", "kitchen_light1"), ("Bedroom", "bedroom_light1"))
+    assert kitchen.notified() == [("Update", 1, [("Bedroom", "bedroom_light1")])]
+    assert hub.unsubscribe("kitchen") == 1
+    assert len(hub) == 0
+    publish(hub, 2, ("Bedroom", "bedroom_light1"))
+    assert len(kitchen.sent) == 1
+
+def test_slow_subscriber_gets_one_overflow_notice_then_resyncs():
+    hub = SubscriptionHub()
+    slow = subscribe(hub, "slow")
+    fast = subscribe(hub, "fast")
+    publish(hub, 1, ("Kitchen", "kitchen_light1"))
+
+    slow.backlog = NOTIFY_BUFFER_LIMIT + 1
+    for version in (2, 3, 4):
+        publish(hub, version, ("Kitchen", "kitchen_light1"))
+    # Only the first drop is reported while the backlog lasts
+    assert slow.notified()[1:] == [("Overflow", 1, [])]
+    assert slow.dropped == 3
+
+    slow.backlog = 0
+    publish(hub, 5, ("Bedroom", "bedroom_light1"))
+    # Versions 3 and 4 were dropped after the notice went out, so another one precedes the update
+    assert slow.notified()[2:] == [("Overflow", 2, []), ("Update", 5, [("Bedroom", "bedroom_light1")])]
+    assert [version for _, version, _ in fast.notified()] == [1, 2, 3, 4, 5]
+
+if __name__ == "__main__":
+    tests = [value for name, value in list(globals().items()) if name.startswith("test_")]
+    for test in tests:
+        test()
+        print(f"[TEST] {test.__name__} passed")
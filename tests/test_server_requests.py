@@ -0,0 +1,172 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import shutil
+import tempfile
+import contextlib
+import networking.server as server
+from networking.pubsub import SubscriptionHub
+
+DATA_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "smart_home.json")
+
+@contextlib.contextmanager
+def running_home():
+    """Points the server at a fresh copy of the stored home, as a restart would"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "smart_home.json")
+        shutil.copy(DATA_FILE, path)
+        data_file = server.DATA_FILE
+        server.DATA_FILE = path
+        server.cached_data = None
+        server.device_index = None
+        server.list_cache = None
+        server.state_version = 0
+        server.room_versions = {}
+        server.change_log.clear()
+        server.subscriptions = SubscriptionHub()
+        server.configure_storage()
+        try:
+            yield path
+        finally:
+            server.close_storage()
+            server.store = None
+            server.cached_data = None
+            server.DATA_FILE = data_file
+
+def device(room, name):
+    data = server.load_data()
+    if name == "house_alarm":
+        return data["home"]["special_devices"]["house_alarm"]
+    return data["home"]["rooms"][room]["devices"][name]
+
+def test_atomic_batch_rolls_back_when_an_item_fails():
+    with running_home() as path:
+        server.load_data()
+        version = server.state_version
+        result = server.change_devices_batch([
+            {"room": "Kitchen", "device": "kitchen_light1", "status": "on"},
+            {"room": "Bedroom", "device": "bedroom_lock1", "status": "unlocked", "pin": "0000"},
+            {"room": "Garage", "device": "garage_light1", "status": "on"},
+        ])
+        assert result["error"].startswith("Batch rolled back: 2 of 3")
+        assert [item["status"] for item in result["results"]] == ["Success", "Error", "Error"]
+        # Nothing was published, stamped or stored
+        assert device("Kitchen", "kitchen_light1")["status"] == "off"
+        assert server.state_version == version
+        server.close_storage()
+        assert json.load(open(path)) == json.load(open(DATA_FILE))
+
+def test_batch_commits_every_item_at_one_version():
+    with running_home() as path:
+        result = server.change_devices_batch([
+            {"room": "Kitchen", "device": "kitchen_light1", "status": "on", "brightness": "80"},
+            {"room": "Bedroom", "device": "bedroom_lock1", "status": "unlocked", "pin": "1234"},
+            {"room": None, "device": "house_alarm", "status": "armed", "pin": "4321"},
+            {"room": "Bedroom", "device": "bedroom_light2", "status": "off"},
+        ])
+        assert result["success"] == "3 of 4 changes applied"
+        assert [item["status"] for item in result["results"]] == ["Success", "Success", "Success", "Info"]
+        assert device("Kitchen", "kitchen_light1")["brightness"] == 80
+        versions = {device(room, name)["version"] for room, name in
+                    [("Kitchen", "kitchen_light1"), ("Bedroom", "bedroom_lock1"), (None, "house_alarm")]}
+        assert versions == {server.state_version}
+
+        server.close_storage()
+        assert json.load(open(path)) == server.load_data()
+
+def test_non_atomic_batch_keeps_the_items_that_worked():
+    with running_home():
+        result = server.change_devices_batch([
+            {"room": "Kitchen", "device": "kitchen_light1", "status": "on"},
+            {"room": "Kitchen", "device": "kitchen_light1", "color": "mauve"},
+            "not a change",
+        ], atomic=False)
+        assert result["error"] == "1 of 3 changes applied"
+        assert [item["status"] for item in result["results"]] == ["Success", "Error", "Error"]
+        assert device("Kitchen", "kitchen_light1")["status"] == "on"
+        assert device("Kitchen", "kitchen_light1")["color"] == "red"
+
+def found(result):
+    return sorted((room, name) for room, entry in result.items() for name in entry["devices"])
+
+def test_search_combines_every_criterion():
+    with running_home():
+        assert found(server.search_devices(device_type="light", status="off")) == [
+            ("Bedroom", "bedroom_light2"), ("Kitchen", "kitchen_light1"),
+            ("Living Room", "living_room_light2"), ("Living Room", "living_room_light3")]
+        assert found(server.search_devices(device_type="light", status="off", room="Kitchen", color="RED")) == [
+            ("Kitchen", "kitchen_light1")]
+        assert found(server.search_devices(query="bed lock")) == [
+            ("Bedroom", "bedroom_lock1"), ("Bedroom", "bedroom_lock2")]
+        assert found(server.search_devices(query="bed", status="locked")) == [("Bedroom", "bedroom_lock1")]
+        assert server.search_devices(device_type="light", color="green") == {"error": "No devices match the search"}
+
+def test_search_brightness_ranges():
+    with running_home():
+        # Stored brightness may be a number or a numeric string
+        assert found(server.search_devices(min_brightness="50", max_brightness=50)) == [
+            ("Bedroom", "bedroom_light1"), ("Kitchen", "kitchen_light1"), ("Living Room", "living_room_light1")]
+        assert found(server.search_devices(max_brightness=0)) == [
+            ("Bedroom", "bedroom_light2"), ("Living Room", "living_room_light2"), ("Living Room", "living_room_light3")]
+        assert found(server.search_devices(min_brightness=1, room="Bedroom")) == [("Bedroom", "bedroom_light1")]
+        assert "error" in server.search_devices(min_brightness="bright")
+
+        # The index follows commits
+        server.change_device_status("Bedroom", "bedroom_light2", "on", brightness=90)
+        assert found(server.search_devices(min_brightness=60)) == [("Bedroom", "bedroom_light2")]
+        assert found(server.search_devices(status="on", device_type="light")) == [("Bedroom", "bedroom_light2")]
+
+def remove_device(room, name):
+    """Publishes a snapshot without a device, as editing the home by hand and reloading would"""
+    with server.data_lock:
+        data, index = server.query_device_index(lambda index: index)
+        rooms = dict(data["home"]["rooms"])
+        devices = dict(rooms[room]["devices"])
+        del devices[name]
+        rooms[room] = dict(rooms[room], devices=devices)
+        version = server.state_version + 1
+        server.cached_data = dict(data, home=dict(data["home"], rooms=rooms))
+        index.advance(server.cached_data, [{"room": room, "device": name, "fields": {"version": version}}])
+        server.state_version = version
+
+def test_list_since_returns_changed_devices_and_tombstones():
+    with running_home():
+        server.load_data()
+        start = server.state_version
+        assert server.get_device_changes(start) == ({}, [], start)
+
+        server.change_device_status("Kitchen", "kitchen_light1", "on")
+        server.change_house_alarm_status("armed", "4321")
+        middle = server.state_version
+        server.change_device_status("Bedroom", "bedroom_light1", "off")
+        remove_device("Living Room", "living_room_light3")
+        server.change_device_status("Kitchen", "kitchen_light1", "off")
+
+        result, removed, version = server.get_device_changes(start)
+        assert version == server.state_version == start + 5
+        assert found(result) == [("Bedroom", "bedroom_light1"), ("Home", "house_alarm"), ("Kitchen", "kitchen_light1")]
+        assert result["Kitchen"]["devices"]["kitchen_light1"]["status"] == "off"
+        assert removed == [{"room": "Living Room", "device": "living_room_light3"}]
+
+        result, removed, _ = server.get_device_changes(middle)
+        assert found(result) == [("Bedroom", "bedroom_light1"), ("Kitchen", "kitchen_light1")]
+        assert removed == [{"room": "Living Room", "device": "living_room_light3"}]
+
+        # One room only, and nothing once the client is up to date
+        result, removed, _ = server.get_device_changes(start, "Kitchen")
+        assert found(result) == [("Kitchen", "kitchen_light1")] and removed == []
+        assert server.get_device_changes(version) == ({}, [], version)
+
+def test_list_since_rejects_bad_versions_and_rooms():
+    with running_home():
+        assert server.get_device_changes("yesterday") == ({"error": "Invalid version"}, [], None)
+        assert server.get_device_changes(-1) == ({"error": "Invalid version"}, [], None)
+        assert server.get_device_changes(0, "Garage") == ({"error": "Room 'Garage' not found"}, [], None)
+
+if __name__ == "__main__":
+    tests = [value for name, value in list(globals().items()) if name.startswith("test_")]
+    for test in tests:
+        test()
+        print(f"[TEST] {test.__name__} passed")
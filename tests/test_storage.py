@@ -0,0 +1,205 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import shutil
+import sqlite3
+import tempfile
+from storage.json_store import JSONStore
+from storage.sqlite_store import SQLiteStore
+from storage.snapshot import Draft
+
+DATA_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "smart_home.json")
+
+def make_home(directory):
+    """Copies the stored home into directory and returns its path"""
+    path = os.path.join(directory, "smart_home.json")
+    shutil.copy(DATA_FILE, path)
+    return path
+
+def commit(store, data, *changes):
+    """Applies (room, device, fields) changes the way the server does and records them"""
+    draft = Draft(data)
+    records = []
+    for room, device, fields in changes:
+        draft.update_device(room, device, fields)
+        records.append({"room": room, "device": device, "fields": fields})
+    store.record(records, draft.data)
+    return draft.data
+
+def light_changes(count):
+    """count commits that each change a Kitchen light, then the house alarm"""
+    for i in range(count):
+        yield ("Kitchen", "kitchen_light1", {"status": "on" if i % 2 else "off", "brightness": i, "version": i + 1})
+    yield (None, "house_alarm", {"status": "armed", "version": count + 1})
+
+def test_journal_round_trip_across_compaction():
+    with tempfile.TemporaryDirectory() as directory:
+        path = make_home(directory)
+        store = JSONStore(path, journal=True, compact_threshold=512)
+        data = store.load()
+        for change in light_changes(20):
+            data = commit(store, data, change)
+        # Past the threshold: the journal is folded into a new snapshot
+        store.flush()
+        assert not os.path.exists(store.compacting_path)
+        assert json.load(open(path)) == data
+
+        data = commit(store, data, ("Bedroom", "bedroom_light1", {"status": "on", "version": 22}),
+                      ("Kitchen", "kitchen_light1", {"color": "blue", "version": 22}))
+        store.close()
+        assert os.path.getsize(store.journal_path) > 0
+
+        # A restart replays the records written after the compaction over the snapshot
+        assert JSONStore(path, journal=True).load() == data
+
+def test_torn_last_record_is_skipped():
+    with tempfile.TemporaryDirectory() as directory:
+        path = make_home(directory)
+        store = JSONStore(path, journal=True)
+        data = store.load()
+        for change in light_changes(3):
+            data = commit(store, data, change)
+        store.close()
+        # A crash halfway through appending the next commit
+        with open(store.journal_path, "a") as journal:
+            journal.write('[{"room":"Kitchen","device":"kitchen_light1","fields":{"status":')
+
+        store = JSONStore(path, journal=True)
+        assert store.load() == data
+        # The next commit starts on a line of its own and survives the torn one
+        data = commit(store, data, ("Bedroom", "bedroom_light1", {"status": "on", "version": 5}))
+        store.close()
+        assert JSONStore(path, journal=True).load() == data
+
+def test_record_for_an_unknown_device_is_skipped():
+    with tempfile.TemporaryDirectory() as directory:
+        path = make_home(directory)
+        store = JSONStore(path, journal=True)
+        data = commit(store, store.load(), ("Kitchen", "kitchen_light1", {"status": "on", "version": 1}))
+        # Changes to a device and room the snapshot does not have, say after it was edited by hand
+        store.record([{"room": "Kitchen", "device": "kitchen_light1", "fields": {"status": "off"}},
+                      {"room": "Garage", "device": "garage_light1", "fields": {"status": "on"}}], data)
+        data = commit(store, data, ("Bedroom", "bedroom_light1", {"status": "on", "version": 3}))
+        store.close()
+        assert JSONStore(path, journal=True).load() == data
+
+def test_interrupted_compaction_is_replayed_and_merged():
+    with tempfile.TemporaryDirectory() as directory:
+        path = make_home(directory)
+        store = JSONStore(path, journal=True, compact_threshold=512)
+        data = store.load()
+        data = commit(store, data, ("Kitchen", "kitchen_light1", {"status": "on", "version": 1}))
+        store.close()
+        # Crash after the journal was moved aside but before the snapshot was written
+        os.replace(store.journal_path, store.compacting_path)
+
+        store = JSONStore(path, journal=True, compact_threshold=512)
+        assert store.load() == data
+        for change in light_changes(20):
+            data = commit(store, data, change)
+        assert JSONStore(path, journal=True).load() == data
+
+        # The next compaction merges both sets of records before it writes the snapshot,
+        # so crashing right after that loses nothing either
+        store._rotate_journal()
+        assert not os.path.exists(store.journal_path)
+        assert JSONStore(path, journal=True).load() == data
+        store.flush()
+        store.close()
+        assert not os.path.exists(store.compacting_path)
+        assert json.load(open(path)) == data
+        assert JSONStore(path, journal=True).load() == data
+
+def test_compaction_keeps_a_commit_made_while_it_waits_for_the_lock():
+    with tempfile.TemporaryDirectory() as directory:
+        path = make_home(directory)
+        store = JSONStore(path, journal=True, compact_threshold=512)
+        data = store.load()
+        for change in light_changes(20):
+            data = commit(store, data, change)
+
+        class CommitOnEntry:
+            """The persist lock, taken by a commit just ahead of the flusher"""
+            def __enter__(self):
+                nonlocal data
+                data = commit(store, data, ("Bedroom", "bedroom_light1", {"status": "on", "version": 22}))
+            def __exit__(self, *exc):
+                return False
+
+        store.flush(CommitOnEntry())
+        # A crash now must not lose the commit that slipped in
+        assert JSONStore(path, journal=True).load() == data
+        store.close()
+
+def test_sqlite_round_trip():
+    with tempfile.TemporaryDirectory() as directory:
+        json_path = make_home(directory)
+        store = SQLiteStore(os.path.join(directory, "smart_home.db"), json_path)
+        data = store.load()
+        assert data == json.load(open(json_path))
+        for change in light_changes(3):
+            data = commit(store, data, change)
+        store.close()
+
+        store = SQLiteStore(os.path.join(directory, "smart_home.db"), json_path)
+        assert store.load() == data
+        store.close()
+
+def test_sqlite_keeps_every_user_and_room_field():
+    with tempfile.TemporaryDirectory() as directory:
+        json_path = make_home(directory)
+        data = json.load(open(json_path))
+        data["users"]["admin"]["role"] = "owner"
+        data["users"]["guest"] = {"password": "0000", "expires": "2025-04-01", "rooms": ["Kitchen"]}
+        data["home"]["rooms"]["Kitchen"]["floor"] = 0
+        data["home"]["rooms"]["Bedroom"]["owner"] = {"name": "admin"}
+        db_path = os.path.join(directory, "smart_home.db")
+        store = SQLiteStore(db_path)
+        store.save(data)
+        store.close()
+        assert SQLiteStore(db_path).load() == data
+
+def test_sqlite_adds_columns_to_an_older_database():
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, "smart_home.db")
+        conn = sqlite3.connect(db_path)
+        conn.executescript("CREATE TABLE users (username TEXT PRIMARY KEY, password TEXT NOT NULL);"
+                           "CREATE TABLE rooms (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, room_id TEXT);"
+                           "INSERT INTO users VALUES ('admin', '1234');"
+                           "INSERT INTO rooms (name, room_id) VALUES ('Kitchen', '2');")
+        conn.close()
+        store = SQLiteStore(db_path)
+        assert store.load() == {"users": {"admin": {"password": "1234"}},
+                                "home": {"rooms": {"Kitchen": {"room_id": "2", "devices": {}}}}}
+        store.close()
+
+def test_sqlite_record_for_an_unknown_device_is_skipped():
+    with tempfile.TemporaryDirectory() as directory:
+        json_path = make_home(directory)
+        db_path = os.path.join(directory, "smart_home.db")
+        store = SQLiteStore(db_path, json_path)
+        data = store.load()
+        store.record([{"room": "Garage", "device": "garage_light1", "fields": {"status": "on"}},
+                      {"room": "Kitchen", "device": "kitchen_light9", "fields": {"status": "on"}}], data)
+        data = commit(store, data, ("Kitchen", "kitchen_light1", {"status": "on", "version": 2}))
+        store.close()
+        assert SQLiteStore(db_path).load() == data
+
+def test_draft_leaves_published_snapshot_untouched():
+    data = json.load(open(DATA_FILE))
+    before = json.dumps(data, sort_keys=True)
+    draft = Draft(data)
+    draft.update_device("Kitchen", "kitchen_light1", {"status": "on"})
+    draft.update_device(None, "house_alarm", {"status": "armed"})
+    assert json.dumps(data, sort_keys=True) == before
+    assert draft.data["home"]["rooms"]["Kitchen"]["devices"]["kitchen_light1"]["status"] == "on"
+    # Rooms the draft did not touch are shared, not copied
+    assert draft.data["home"]["rooms"]["Bedroom"] is data["home"]["rooms"]["Bedroom"]
+
+if __name__ == "__main__":
+    tests = [value for name, value in list(globals().items()) if name.startswith("test_")]
+    for test in tests:
+        test()
+        print(f"[TEST] {test.__name__} passed")